@@ -0,0 +1,120 @@
+"""
+Persistent cache for embeddings, so that unchanged text is never sent to the embedding API twice.
+
+Vectors are stored as raw float32 bytes in a sqlite table keyed by SHA-256(model + "\\0" + text),
+with an in-process LRU layer on top for documents repeated within one run.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from mci.ir.IR import Vector
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mci", "embeddings")
+MEMORY_SIZE = 4096  # number of vectors kept in memory
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model: str, document: str) -> bytes:
+    return hashlib.sha256(model.encode() + b"\0" + document.encode()).digest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding store.
+
+    If the database cannot be opened (e.g. read-only home directory), only the in-memory
+    layer is used.
+    """
+
+    def __init__(self, cache_dir: str, memory_size: int = MEMORY_SIZE) -> None:
+        self.memory_size = memory_size
+        self._memory: OrderedDict[bytes, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            db = sqlite3.connect(os.path.join(cache_dir, "cache.db"), check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vec BLOB)")
+            db.commit()
+            self._db = db
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Embedding cache disabled for %s: %s", cache_dir, e)
+
+    def _remember(self, key: bytes, data: bytes) -> None:
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: bytes) -> Optional[Vector]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+            elif self._db is not None:
+                try:
+                    row = self._db.execute(
+                        "SELECT vec FROM embeddings WHERE hash = ?", (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    logger.warning("Failed to read embedding from cache: %s", e)
+                    return None
+                if row is None:
+                    return None
+                data = row[0]
+                self._remember(key, data)
+            else:
+                return None
+        return np.frombuffer(data, dtype=np.float32).copy()
+
+    def put(self, key: bytes, vector: Vector) -> None:
+        self.put_many([(key, vector)])
+
+    def put_many(self, items: List[Tuple[bytes, Vector]]) -> None:
+        """Store several vectors in one transaction."""
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items]
+        if not rows:
+            return
+        with self._lock:
+            for key, data in rows:
+                self._remember(key, data)
+            if self._db is not None:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)", rows
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning("Failed to store embeddings in cache: %s", e)
+
+
+_cache: Optional[EmbeddingCache] = None
+
+
+def get_cache() -> EmbeddingCache:
+    """Return the process-wide cache, opened in CACHE_DIR on first use."""
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(CACHE_DIR)
+    return _cache
+
+
+def lookup(model: str, document: str) -> Optional[Vector]:
+    return get_cache().get(cache_key(model, document))
+
+
+def store(model: str, document: str, vector: Vector) -> None:
+    get_cache().put(cache_key(model, document), vector)
+
+
+def store_many(model: str, items: List[Tuple[str, Vector]]) -> None:
+    get_cache().put_many([(cache_key(model, document), vector) for document, vector in items])
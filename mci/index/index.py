@@ -1,33 +1,73 @@
 import asyncio
-import math
+import json
 import os
 import pickle
 import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import numpy as np
+import numpy.typing as npt
 import openai
 import pytest
 import tiktoken
 from tenacity import retry, wait_exponential
 
 import mci.ir.IR as IR
+from mci.index import embed_cache
 from mci.ir.IR import SymbolKindName, Vector
 from mci.ir.parser import parse_files_in_paths
 
 debug = False
-version = "0.0.3"
+version = "0.0.7"
+# files of a saved index: `path + META_SUFFIX`, and the data files `f"{path}.{save_id}" + suffix`
+META_SUFFIX = ".meta.json"  # version, options, save_id, and the paths and ids of the embeddings
+ROWS_SUFFIX = ".rows.npz"  # symbols of the embeddings, as numbers within their file
+VECS_SUFFIX = ".vecs.npy"  # search matrix
+VECS_COMPRESSED_SUFFIX = ".vecs.npz"  # search matrix, when saved compressed
+PROJECT_SUFFIX = ".project.pkl"  # the project, without the embeddings of the symbols
+DATA_SUFFIXES = [ROWS_SUFFIX, VECS_SUFFIX, VECS_COMPRESSED_SUFFIX, PROJECT_SUFFIX]
 MAX_TOKENS = 8192
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_BATCH_SIZE = 96  # max documents per embedding request
+EMBEDDING_BATCH_TOKENS = 300_000  # max total tokens per embedding request
 Encoder = tiktoken.get_encoding("cl100k_base")
 GLOBAL_SEMAPHORE = asyncio.Semaphore(16)
+NUM_THREADS = os.cpu_count() or 1  # for batch encoding with tiktoken
+PARALLEL_MIN_FILES = 64  # projects with fewer files are indexed in-process
 
 
 def token_length(string: str) -> int:
     return len(Encoder.encode(string))
 
 
+def normalize(vector: Vector) -> Vector:
+    """Scale a vector to unit length, so that cosine similarity becomes a dot product."""
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return (vector / norm).astype(np.float32, copy=False)
+
+
+Scores = npt.NDArray[np.floating[Any]]
+LeafScores = Callable[["Text"], Scores]
+
+
 @dataclass
 class Node(ABC):
     """Helper class to represent nodes in a boolean query tree."""
@@ -39,20 +79,32 @@ class Node(ABC):
         """
         raise NotImplementedError
 
+    def leaves(self) -> List["Text"]:
+        """
+        Returns the text leaves of the tree rooted at the node.
+        """
+        return []
+
+    def node_scores(self, leaf_scores: LeafScores, symbols: List[IR.Symbol]) -> Scores:
+        """
+        Computes the similarity between the node and each of `symbols` at once.
+        `leaf_scores` returns the similarity of a text leaf with each of `symbols`.
+        """
+        return np.fromiter(
+            (self.node_similarity(symbol) for symbol in symbols),
+            dtype=np.float64,
+            count=len(symbols),
+        )
+
     @classmethod
     def cosine_similarity(cls, a: Vector, b: Vector) -> float:
         """
         Computes the cosine similarity between two vectors.
         """
-        dot_product = a.dot(b)
-        norm_a = np.linalg.norm(a)
-        norm_b = np.linalg.norm(b)
-        if norm_a == 0 or norm_b == 0:
+        norm_squared = np.vdot(a, a) * np.vdot(b, b)
+        if norm_squared == 0:
             return 0.0
-        result = dot_product / (norm_a * norm_b)
-        if math.isnan(result):
-            return 0.0
-        return result
+        return float(np.dot(a, b) / np.sqrt(norm_squared))
 
 
 class Text(Node):
@@ -61,16 +113,38 @@ class Text(Node):
     text: str
     vector: Vector
 
-    def __init__(self, text: str) -> None:
+    def __init__(self, text: str, vector: Optional[Vector] = None) -> None:
+        """
+        Embeds `text` unless its `vector` is given. This blocks, so inside an event loop
+        use `await Text.aembed(text)` instead.
+        """
+        if vector is None:
+            vector = openai_embedding_sync(text)
+        self._set(text, vector)
+
+    def _set(self, text: str, vector: Optional[Vector]) -> None:
+        """If the embedding failed, the vector is empty and the node matches no symbol."""
         self.text = text
-        vector = openai_embedding_sync(text)
-        if vector is not None:
-            self.vector = vector
+        self.vector = np.zeros(0, dtype=np.float32) if vector is None else normalize(vector)
+
+    @classmethod
+    async def aembed(cls, text: str) -> "Text":
+        """Create a text node, embedding the text without blocking the event loop."""
+        node = cls.__new__(cls)
+        node._set(text, await openai_embedding(text))
+        return node
 
     def node_similarity(self, symbol: IR.Symbol) -> float:
-        if symbol.embedding is None:
+        # both vectors are normalized, so the dot product is the cosine similarity
+        if symbol.embedding is None or len(self.vector) == 0:
             return 0.0
-        return self.cosine_similarity(symbol.embedding, self.vector)
+        return float(symbol.embedding @ self.vector)
+
+    def leaves(self) -> List["Text"]:
+        return [self]
+
+    def node_scores(self, leaf_scores: LeafScores, symbols: List[IR.Symbol]) -> Scores:
+        return leaf_scores(self)
 
 
 @dataclass
@@ -87,6 +161,12 @@ class Not(Node):
     def node_similarity(self, symbol: IR.Symbol) -> float:
         return self.op(self.node.node_similarity(symbol))
 
+    def leaves(self) -> List["Text"]:
+        return self.node.leaves()
+
+    def node_scores(self, leaf_scores: LeafScores, symbols: List[IR.Symbol]) -> Scores:
+        return 1 - self.node.node_scores(leaf_scores, symbols)
+
 
 class And(Node):
     """Helper class to represent and nodes in a boolean query tree."""
@@ -108,6 +188,12 @@ class And(Node):
     def node_similarity(self, symbol: IR.Symbol) -> float:
         return self.op([x.node_similarity(symbol) for x in self.arguments])
 
+    def leaves(self) -> List["Text"]:
+        return [leaf for x in self.arguments for leaf in x.leaves()]
+
+    def node_scores(self, leaf_scores: LeafScores, symbols: List[IR.Symbol]) -> Scores:
+        return np.minimum.reduce([x.node_scores(leaf_scores, symbols) for x in self.arguments])
+
 
 class Or(Node):
     """Helper class to represent or nodes in a boolean query tree."""
@@ -129,6 +215,12 @@ class Or(Node):
     def node_similarity(self, symbol: IR.Symbol) -> float:
         return self.op([x.node_similarity(symbol) for x in self.arguments])
 
+    def leaves(self) -> List["Text"]:
+        return [leaf for x in self.arguments for leaf in x.leaves()]
+
+    def node_scores(self, leaf_scores: LeafScores, symbols: List[IR.Symbol]) -> Scores:
+        return np.maximum.reduce([x.node_scores(leaf_scores, symbols) for x in self.arguments])
+
 
 @dataclass
 class Function(Node):
@@ -147,8 +239,10 @@ class Function(Node):
 
 class Query:
     node: Node
-    kinds: List[IR.SymbolKindName]
+    kinds: FrozenSet[IR.SymbolKindName]
     num_results: int = 5
+    leaf_vectors: npt.NDArray[np.float32]  # (L, D) vectors of the distinct text leaves
+    leaf_columns: Dict[int, int]  # id(leaf) -> row of leaf_vectors
 
     def __init__(
         self,
@@ -160,7 +254,15 @@ class Query:
             query = Text(text=query)
         self.node = query
         self.num_results = num_results
-        self.kinds = kinds
+        self.kinds = frozenset(kinds)
+        leaves = list({id(leaf): leaf for leaf in query.leaves()}.values())
+        self.leaf_columns = {id(leaf): n for n, leaf in enumerate(leaves)}
+        # the leaves whose embedding failed have an empty vector, and keep a row of zeros
+        dim = max((len(leaf.vector) for leaf in leaves), default=0)
+        self.leaf_vectors = np.zeros((len(leaves), dim), dtype=np.float32)
+        for n, leaf in enumerate(leaves):
+            if len(leaf.vector) == dim:
+                self.leaf_vectors[n] = leaf.vector
 
 
 @dataclass
@@ -197,44 +299,151 @@ class Embedding:
 PathWithId = Tuple[str, IR.QualifiedId]
 
 
+class Embeddings(Mapping[PathWithId, Embedding]):
+    """
+    Read-only view of the embeddings of an index, in their original order.
+    The index stores them as columns, and an Embedding object is only created on access.
+    """
+
+    def __init__(self, index: "Index") -> None:
+        self._index = index
+        self._order: List[int] = np.argsort(index._group_rank, kind="stable").tolist()
+        self._groups: Optional[Dict[PathWithId, int]] = None
+
+    def __getitem__(self, path_with_id: PathWithId) -> Embedding:
+        if self._groups is None:
+            self._groups = {key: g for g, key in enumerate(self._index._primary_paths)}
+        g = self._groups[path_with_id]
+        offsets = self._index._group_offsets
+        return Embedding(
+            symbol=self._index._primary_symbols[g],
+            aggregate_symbols=self._index._rows[offsets[g] : offsets[g + 1]],
+        )
+
+    def __iter__(self) -> Iterator[PathWithId]:
+        return (self._index._primary_paths[g] for g in self._order)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __repr__(self) -> str:
+        return f"Embeddings({len(self)} embeddings)"
+
+
+def truncate_documents(documents: List[str]) -> List[Tuple[str, int]]:
+    """
+    Truncate documents to the token limit of the embedding model.
+    Returns each text with an upper bound of its number of tokens.
+
+    A token spans at least one byte, so only documents of at least MAX_TOKENS bytes are encoded,
+    in one batch.
+    """
+    results = [(document, len(document.encode())) for document in documents]
+    long = [n for n, (_, size) in enumerate(results) if size >= MAX_TOKENS]
+    encoded = Encoder.encode_batch([documents[n] for n in long], num_threads=NUM_THREADS)
+    for n, tokens in zip(long, encoded):
+        if len(tokens) >= MAX_TOKENS:
+            print(f"Truncating document to {MAX_TOKENS} tokens")
+            tokens = tokens[
+                : MAX_TOKENS - 1
+            ]  # less than max tokens otherwise the embedding is full of nan
+            results[n] = (Encoder.decode(tokens), len(tokens))
+        else:
+            results[n] = (documents[n], len(tokens))
+    return results
+
+
 @retry(wait=wait_exponential(multiplier=1, min=4, max=10))
-async def openai_embedding(document: str) -> Optional[Vector]:
+async def openai_embedding_batch(texts: List[str]) -> List[Optional[Vector]]:
+    """Embed a batch of already truncated texts with a single request."""
     try:
         async with GLOBAL_SEMAPHORE:
-            print("openai embedding for", document[:20], "...")
-            model = "text-embedding-ada-002"
-            if token_length(document) >= MAX_TOKENS:
-                print(f"Truncating document to {MAX_TOKENS} tokens")
-                tokens = Encoder.encode(document)
-                tokens = tokens[
-                    : MAX_TOKENS - 1
-                ]  # less than max tokens otherwise the embedding is full of nan
-                document = Encoder.decode(tokens)
+            print(f"openai embedding for {len(texts)} documents:", texts[0][:20], "...")
             acreate = openai.Embedding.acreate  # type: ignore
-            vector = acreate(input=[document], model=model)  # type: ignore
-            vector = (await vector)["data"][0]["embedding"]  # type: ignore
-            vector: Vector = np.array(vector)  # type: ignore
-            return vector
+            response = await acreate(input=texts, model=EMBEDDING_MODEL)  # type: ignore
+            data = sorted(response["data"], key=lambda x: x["index"])  # type: ignore
+            return [normalize(np.asarray(d["embedding"], dtype=np.float32)) for d in data]
     except Exception as e:
         print(f"caught {e=} retrying")
+        return [None] * len(texts)
+
+
+async def openai_embeddings(documents: List[str]) -> List[Optional[Vector]]:
+    """
+    Embed a list of documents, in order.
+
+    Documents found in the embedding cache are not sent again, and the others are packed into
+    batches of at most EMBEDDING_BATCH_SIZE documents and EMBEDDING_BATCH_TOKENS tokens.
+    """
+    results: List[Optional[Vector]] = [None] * len(documents)
+    positions: Dict[str, List[int]] = {}  # document -> positions in `documents`
+    for n, document in enumerate(documents):
+        if document in positions:
+            positions[document].append(n)
+            continue
+        cached = embed_cache.lookup(EMBEDDING_MODEL, document)
+        if cached is not None:
+            results[n] = cached
+        else:
+            positions[document] = [n]
+
+    batches: List[List[str]] = []
+    texts: List[List[str]] = []
+    batch_tokens = 0
+    for document, (text, length) in zip(positions, truncate_documents(list(positions))):
+        if (
+            not batches
+            or len(batches[-1]) >= EMBEDDING_BATCH_SIZE
+            or batch_tokens + length > EMBEDDING_BATCH_TOKENS
+        ):
+            batches.append([])
+            texts.append([])
+            batch_tokens = 0
+        batches[-1].append(document)
+        texts[-1].append(text)
+        batch_tokens += length
+
+    embedded = await asyncio.gather(*(openai_embedding_batch(t) for t in texts))
+    for batch, vectors in zip(batches, embedded):
+        # one cache transaction per batch
+        embed_cache.store_many(
+            EMBEDDING_MODEL,
+            [(document, vector) for document, vector in zip(batch, vectors) if vector is not None],
+        )
+        for document, vector in zip(batch, vectors):
+            for n in positions[document]:
+                results[n] = vector
+    return results
+
+
+async def openai_embedding(document: str) -> Optional[Vector]:
+    return (await openai_embeddings([document]))[0]
 
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=10))
 def openai_embedding_sync(document: str) -> Optional[Vector]:
+    """Blocking version of openai_embedding, for code that does not run in an event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return _openai_embedding_sync(document)
+    raise RuntimeError(
+        "openai_embedding_sync would block the running event loop, use openai_embedding"
+    )
+
+
+@retry(wait=wait_exponential(multiplier=1, min=4, max=10))
+def _openai_embedding_sync(document: str) -> Optional[Vector]:
+    cached = embed_cache.lookup(EMBEDDING_MODEL, document)
+    if cached is not None:
+        return cached
     try:
         print("[async] openai embedding for", document[:20], "...")
-        model = "text-embedding-ada-002"
-        if token_length(document) >= MAX_TOKENS:
-            print(f"Truncating document to {MAX_TOKENS} tokens")
-            tokens = Encoder.encode(document)
-            tokens = tokens[
-                : MAX_TOKENS - 1
-            ]  # less than max tokens otherwise the embedding is full of nan
-            document = Encoder.decode(tokens)
+        [(text, _)] = truncate_documents([document])
         create = openai.Embedding.create  # type: ignore
-        vector = create(input=[document], model=model)  # type: ignore
+        vector = create(input=[text], model=EMBEDDING_MODEL)  # type: ignore
         vector = vector["data"][0]["embedding"]  # type: ignore
-        vector: Vector = np.array(vector)  # type: ignore
+        vector: Vector = normalize(np.asarray(vector, dtype=np.float32))  # type: ignore
+        embed_cache.store(EMBEDDING_MODEL, document, vector)
         return vector
     except Exception as e:
         print(f"caught {e=} retrying")
@@ -242,32 +451,335 @@ def openai_embedding_sync(document: str) -> Optional[Vector]:
 
 @dataclass
 class Index:
-    embeddings: Dict[PathWithId, Embedding]  # (file_path, id) -> embedding
+    embeddings: Mapping[PathWithId, Embedding]  # (file_path, id) -> embedding
     project: IR.Project
     version: str = version
+    half_precision: bool = False  # store the search matrix as float16, halving its memory traffic
+
+    DTYPE = np.float32  # dtype of the search matrix and of the dot products
+    UPCAST_BLOCK = 256  # rows of a float16 search matrix converted to DTYPE at a time
+
+    # columns built from `embeddings` by `_build_layout`, and the search matrix; not pickled
+    _derived = (
+        "_E",
+        "_group_offsets",
+        "_group_rank",
+        "_kind_ranges",
+        "_kind_views",
+        "_primary_paths",
+        "_primary_symbols",
+        "_rows",
+    )
+
+    def __post_init__(self) -> None:
+        keys = list(self.embeddings)
+        embeddings = [self.embeddings[key] for key in keys]
+        rows = [symbol for e in embeddings for symbol in e.aggregate_symbols]
+        offsets = np.cumsum([0] + [len(e.aggregate_symbols) for e in embeddings]).tolist()
+        self._build_layout(keys, [e.symbol for e in embeddings], rows, offsets)
+        self._build_matrix()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        for attr in self._derived:
+            state.pop(attr, None)
+        state["embeddings"] = dict(self.embeddings)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.__post_init__()
+
+    def _build_layout(
+        self,
+        keys: Sequence[PathWithId],
+        symbols: Sequence[IR.Symbol],
+        rows: Sequence[IR.Symbol],
+        offsets: Sequence[int],
+    ) -> None:
+        """
+        Store the embeddings as columns: the path and primary symbol of each embedding, and the
+        aggregate symbols of all embeddings, one per row of the search matrix `_E`.
+        Embedding `n` of the arguments has the aggregate symbols `rows[offsets[n]:offsets[n+1]]`.
+
+        The embeddings (groups of rows) are bucketed by the kind of their primary symbol: the
+        groups of each kind are contiguous, and `_kind_ranges` maps a kind to its range of groups.
+        `_group_offsets` holds the first row of each group, followed by the number of rows, and
+        `_group_rank` the original position of each group, used to break ties.
+        """
+        kinds = [symbol.symbol_kind.NAME for symbol in symbols]
+        order = sorted(range(len(keys)), key=lambda n: kinds[n])
+        self._rows: List[IR.Symbol] = []
+        group_offsets: List[int] = []
+        self._kind_ranges: Dict[SymbolKindName, Tuple[int, int]] = {}
+        for g, n in enumerate(order):
+            start, _ = self._kind_ranges.get(kinds[n], (g, g))
+            self._kind_ranges[kinds[n]] = (start, g + 1)
+            group_offsets.append(len(self._rows))
+            self._rows.extend(rows[offsets[n] : offsets[n + 1]])
+        group_offsets.append(len(self._rows))
+        self._group_offsets = np.array(group_offsets, dtype=np.int32)
+        self._group_rank = np.array(order, dtype=np.intp)
+        self._primary_paths: List[PathWithId] = [keys[n] for n in order]
+        self._primary_symbols: List[IR.Symbol] = [symbols[n] for n in order]
+        self._kind_views: Dict[FrozenSet[SymbolKindName], List[Tuple[int, int]]] = {}
+        self.embeddings = Embeddings(self)
+
+    @classmethod
+    def _stack_rows(cls, rows: List[IR.Symbol]) -> npt.NDArray[np.float32]:
+        """Stack the embeddings of `rows` into a row-normalized matrix of dtype `DTYPE`."""
+        vectors = [symbol.embedding for symbol in rows if symbol.embedding is not None]
+        E = np.zeros((len(rows), len(vectors[0]) if vectors else 0), dtype=cls.DTYPE)
+        if vectors:
+            E[[symbol.embedding is not None for symbol in rows]] = np.stack(vectors)
+        norms = np.linalg.norm(E, axis=1, keepdims=True)
+        norms[norms == 0] = 1  # symbols without an embedding keep a zero row
+        E /= norms
+        return E
+
+    def _set_matrix(self, E: npt.NDArray[np.float32]) -> None:
+        self._E = E.astype(np.float16) if self.half_precision else E
+
+    def _build_matrix(self) -> None:
+        """
+        Stack the embeddings of all aggregate symbols into a single row-normalized matrix `_E`,
+        so that a text query is scored against the whole index with one matrix-vector product.
+        """
+        self._set_matrix(self._stack_rows(self._rows))
+
+    def _kind_view(self, kinds: FrozenSet[SymbolKindName]) -> List[Tuple[int, int]]:
+        """Return the ranges of groups whose primary symbol has one of the given kinds."""
+        view = self._kind_views.get(kinds)
+        if view is None:
+            view = sorted(self._kind_ranges[k] for k in kinds if k in self._kind_ranges)
+            self._kind_views[kinds] = view
+        return view
+
+    @staticmethod
+    def _top_k(
+        scores: npt.NDArray[np.float32], rank: npt.NDArray[np.intp], k: int
+    ) -> npt.NDArray[np.intp]:
+        """
+        Return the indices of the `k` highest scores, highest first.
+        Ties are resolved by increasing `rank`, the same as a stable sort in rank order would.
+        """
+        threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > threshold)
+        tied = np.flatnonzero(scores == threshold)
+        tied = tied[np.argsort(rank[tied], kind="stable")][: k - len(above)]
+        top = np.concatenate((above, tied))
+        return top[np.lexsort((rank[top], -scores[top]))]
+
+    def _matrix_scores(self, E: npt.NDArray[Any], V: npt.NDArray[np.float32]) -> Scores:
+        """
+        Return the dot products of every row of `E`, a slice of the search matrix, with every
+        row of `V`, as an array of shape (len(E), len(V)).
+        """
+        if E.shape[1] == 0 or V.shape[1] == 0:  # nothing was embedded, or no text vectors
+            return np.zeros((len(E), len(V)), dtype=self.DTYPE)
+        if E.dtype == self.DTYPE:
+            return E.dot(V.T)
+        # upcast one block at a time, so the float32 copy stays in cache
+        scores = np.empty((len(E), len(V)), dtype=self.DTYPE)
+        for start in range(0, len(E), self.UPCAST_BLOCK):
+            block = E[start : start + self.UPCAST_BLOCK]
+            scores[start : start + len(block)] = block.astype(self.DTYPE).dot(V.T)
+        return scores
+
+    def _node_scores(self, query: Query, ranges: List[Tuple[int, int]]) -> Scores:
+        """
+        Return the similarity of the query with the embeddings in the given ranges of groups.
+        For each range, all the text leaves are scored with one matrix product, the node tree
+        is evaluated on the resulting columns, and each group takes the maximum over its rows.
+        """
+        scores: List[Scores] = []
+        for start, end in ranges:
+            row_start, row_end = self._group_offsets[start], self._group_offsets[end]
+            S = self._matrix_scores(self._E[row_start:row_end], query.leaf_vectors)
+            row_scores = query.node.node_scores(
+                lambda leaf: S[:, query.leaf_columns[id(leaf)]], self._rows[row_start:row_end]
+            )
+            offsets = self._group_offsets[start:end] - row_start
+            scores.append(np.maximum.reduceat(row_scores, offsets))
+        return np.concatenate(scores)
 
     def search(self, query: Query) -> List[Tuple[PathWithId, float, IR.Symbol]]:
-        scores: List[Tuple[PathWithId, float, IR.Symbol]] = [
-            (path_with_id, e.similarity(query=query), e.symbol)
-            for path_with_id, e in self.embeddings.items()
-            if e.symbol.symbol_kind.name() in query.kinds
+        ranges = self._kind_view(query.kinds)
+        groups = np.concatenate([np.arange(start, end) for start, end in ranges] + [[]])
+        groups = groups.astype(np.intp)
+        k = min(query.num_results, len(groups))
+        if k <= 0:
+            return []
+        scores = self._node_scores(query, ranges)
+        top = self._top_k(scores, self._group_rank[groups], k)
+        return [
+            (self._primary_paths[g], float(score), self._primary_symbols[g])
+            for g, score in zip(groups[top], scores[top])
         ]
-        scores = sorted(scores, key=lambda x: x[1], reverse=True)
-        return scores[: query.num_results]
 
-    def save(self, path: str) -> None:
-        with open(path, "wb") as f:
-            pickle.dump(self, f)
+    async def asearch(
+        self,
+        query: Union[str, Query],
+        num_results: int = 5,
+        kinds: List[SymbolKindName] = ["Function"],
+    ) -> List[Tuple[PathWithId, float, IR.Symbol]]:
+        """
+        Search from a coroutine. A query string is embedded with `Text.aembed`, and searched for
+        with the given `num_results` and `kinds`.
+        """
+        if isinstance(query, str):
+            query = Query(await Text.aembed(query), num_results=num_results, kinds=kinds)
+        return self.search(query)
+
+    def save(self, path: str, compress: bool = False) -> None:
+        """
+        Save the index to the files named by the suffixes above. Only the project is pickled:
+        embeddings refer to its symbols by their number in `_file_symbols`.
+
+        The data files are named by a new `save_id`, so they never overwrite those of the
+        previous save. Replacing the metadata, which names the `save_id`, is the only step that
+        switches `path` to the new save; the data files of the previous save are removed after
+        it. A failed save removes its own files and leaves the previous save readable, and an
+        index memory-mapped from `path` keeps working.
+
+        With `compress`, the search matrix is saved deflated, for storage or transfer. It is
+        decompressed to `VECS_SUFFIX` by the first `load`.
+        """
+        save_id = os.urandom(8).hex()
+        prefix = f"{path}.{save_id}"
+        numbers: Dict[str, Dict[int, int]] = {
+            file.path: {id(symbol): n for n, symbol in enumerate(_file_symbols(file))}
+            for file in self.project.get_files()
+        }
+        order = np.argsort(self._group_rank, kind="stable").tolist()  # original order
+        paths = [self._primary_paths[g][0] for g in order]
+        offsets = self._group_offsets.tolist()
+        try:
+            primary = [numbers[p][id(self._primary_symbols[g])] for p, g in zip(paths, order)]
+            symbols = [
+                numbers[p][id(symbol)]
+                for p, g in zip(paths, order)
+                for symbol in self._rows[offsets[g] : offsets[g + 1]]
+            ]
+        except KeyError:
+            raise ValueError("Only symbols of a file of the project can be saved for that file.")
+        sizes = [offsets[g + 1] - offsets[g] for g in order]
+        meta = {
+            "version": self.version,
+            "save_id": save_id,
+            "half_precision": self.half_precision,
+            "paths": paths,
+            "ids": [self._primary_paths[g][1] for g in order],
+        }
+        rows = {
+            "save_id": np.array(save_id),
+            "primary": np.array(primary, dtype=np.int32),
+            "offsets": np.cumsum([0] + sizes, dtype=np.int32),
+            "symbols": np.array(symbols, dtype=np.int32),
+            # in the order of the search matrix
+            "embedded": np.array([s.embedding is not None for s in self._rows], dtype=bool),
+        }
+        vecs = self._E if self._E.dtype == self.DTYPE else self._stack_rows(self._rows)
+
+        previous_id = _saved_id(path)
+        switched = False
+        try:
+            saved = [(s, s.embedding) for s in self._rows]
+            for symbol in self._rows:
+                symbol.embedding = None
+            try:
+                project = {"save_id": save_id, "project": self.project}
+                _write_file(prefix + PROJECT_SUFFIX, lambda f: pickle.dump(project, f))
+            finally:
+                for symbol, embedding in saved:
+                    symbol.embedding = embedding
+            if compress:
+                _write_file(
+                    prefix + VECS_COMPRESSED_SUFFIX, lambda f: np.savez_compressed(f, vecs=vecs)
+                )
+            else:
+                _write_file(prefix + VECS_SUFFIX, lambda f: np.save(f, vecs))
+            _write_file(prefix + ROWS_SUFFIX, lambda f: np.savez(f, **rows))
+            _write_file(path + META_SUFFIX, lambda f: f.write(json.dumps(meta).encode()))
+            switched = True
+        finally:
+            if not switched:
+                _remove_files([prefix + suffix for suffix in DATA_SUFFIXES])
+        if previous_id is not None:
+            _remove_files([f"{path}.{previous_id}{suffix}" for suffix in DATA_SUFFIXES])
 
     @classmethod
     def load(cls, path: str) -> "Index":
-        with open(path, "rb") as f:
-            index = pickle.load(f)
+        """
+        Load an index saved by `save`. The search matrix is memory-mapped, so only the metadata
+        is read upfront, and the embeddings of the aggregate symbols are views of its rows.
+        """
+        if not os.path.exists(path + META_SUFFIX) and os.path.exists(path):
+            raise ValueError(
+                f"Index version of {path} is not supported: it was saved as a single pickle by"
+                " an older version. Re-run `morph index` to create it again."
+            )
+        with open(path + META_SUFFIX, "rb") as f:
+            meta = json.load(f)
         # check version
-        if index.version != version:
-            raise ValueError(f"Index version {index.version} is not supported.")
+        if meta["version"] != version:
+            raise ValueError(f"Index version {meta['version']} is not supported.")
+        prefix = f"{path}.{meta['save_id']}"
+        with open(prefix + PROJECT_SUFFIX, "rb") as f:
+            saved_project = pickle.load(f)
+        with np.load(prefix + ROWS_SUFFIX) as data:
+            rows = {name: data[name] for name in data.files}
+        if saved_project["save_id"] != meta["save_id"] or rows["save_id"] != meta["save_id"]:
+            raise ValueError(f"Index files {path}.* do not come from the same save.")
+        project: IR.Project = saved_project["project"]
+        files = {file.path: file for file in project.get_files()}
+        file_symbols: Dict[str, List[IR.Symbol]] = {}
+        for p in meta["paths"]:
+            if p not in file_symbols:
+                file_symbols[p] = _file_symbols(files[p])
+        offsets = rows["offsets"].tolist()
+        primary = rows["primary"].tolist()
+        numbers = rows["symbols"].tolist()
+        paths = meta["paths"]
+        aggregate_symbols = [
+            file_symbols[paths[n]][m]
+            for n in range(len(paths))
+            for m in numbers[offsets[n] : offsets[n + 1]]
+        ]
+
+        index = cls.__new__(cls)
+        index.project = project
+        index.version = meta["version"]
+        index.half_precision = meta["half_precision"]
+        index._build_layout(
+            list(zip(paths, meta["ids"])),
+            [file_symbols[p][n] for p, n in zip(paths, primary)],
+            aggregate_symbols,
+            offsets,
+        )
+        vecs = cls._load_vecs(prefix)
+        if len(vecs) != len(index._rows):
+            raise ValueError(f"Index files {path}.* do not come from the same save.")
+        for n in np.flatnonzero(rows["embedded"]):
+            index._rows[n].embedding = vecs[n]
+        for file in files.values():
+            file.embeddings_changed()
+        index._set_matrix(vecs)
         return index
 
+    @classmethod
+    def _load_vecs(cls, prefix: str) -> npt.NDArray[np.float32]:
+        """Memory-map the search matrix, decompressing it first if it was saved compressed."""
+        if not os.path.exists(prefix + VECS_SUFFIX):
+            with np.load(prefix + VECS_COMPRESSED_SUFFIX) as data:
+                vecs = data["vecs"]
+            try:
+                _write_file(prefix + VECS_SUFFIX, lambda f: np.save(f, vecs))
+            except OSError as e:
+                print(f"Cannot write {prefix + VECS_SUFFIX}, keeping the index in memory: {e}")
+                return vecs
+        return np.load(prefix + VECS_SUFFIX, mmap_mode="r")
+
     @dataclass
     class EmbeddingItem(ABC):
         """abstract class for embedding items: either a document or a reference"""
@@ -296,35 +808,99 @@ class Index:
         path_with_id: PathWithId
         symbol: IR.Symbol
 
+    @dataclass
+    class IndexingCache:
+        """
+        Caches used while collecting the documents to embed, keyed by id(symbol).
+        A cache is only valid for a fixed choice of kinds and max_tokens.
+        """
+
+        token_lengths: Dict[int, int] = field(default_factory=dict)
+        fits_length: Dict[int, bool] = field(default_factory=dict)
+        needs_indexing: Dict[int, bool] = field(default_factory=dict)
+        nested_items: Dict[int, List["Index.EmbeddingItem"]] = field(default_factory=dict)
+        texts: Dict[int, str] = field(default_factory=dict)  # decoded, for symbols that fit
+
+        def add_token_lengths(self, file: IR.File, max_tokens: int) -> None:
+            """
+            Compute the token lengths of the symbols in a file with one batch encoding,
+            keeping the decoded text of the symbols that fit in `max_tokens`.
+            Symbols short enough to fit in any case are left to `symbol_fits_length`.
+            """
+            symbols: List[IR.Symbol] = []
+            stack = [file.symbol] if file.symbol else []
+            while stack:
+                symbol = stack.pop()
+                stack.extend(symbol.body)
+                sub = symbol.substring
+                # tiktoken dies on large strings
+                if max_tokens < sub[1] - sub[0] <= max_tokens * 10:
+                    symbols.append(symbol)
+            texts = [symbol.get_substring().decode() for symbol in symbols]
+            encoded = Encoder.encode_batch(texts, num_threads=NUM_THREADS)
+            for symbol, text, tokens in zip(symbols, texts, encoded):
+                self.token_lengths[id(symbol)] = len(tokens)
+                if len(tokens) <= max_tokens:
+                    self.texts[id(symbol)] = text
+
     @classmethod
-    def symbol_fits_length(cls, symbol: IR.Symbol, max_tokens: int) -> bool:
+    def symbol_fits_length(
+        cls, symbol: IR.Symbol, max_tokens: int, cache: Optional["Index.IndexingCache"] = None
+    ) -> bool:
+        if cache is not None and id(symbol) in cache.fits_length:
+            return cache.fits_length[id(symbol)]
         sub = symbol.substring
-        if sub[1] - sub[0] > max_tokens * 10:  # tiktoken dies on large strings
-            return False
-        return token_length(symbol.get_substring().decode()) <= max_tokens
+        if sub[1] - sub[0] <= max_tokens:  # a token is at least one byte
+            fits = True
+        elif sub[1] - sub[0] > max_tokens * 10:  # tiktoken dies on large strings
+            fits = False
+        elif cache is not None and id(symbol) in cache.token_lengths:
+            fits = cache.token_lengths[id(symbol)] <= max_tokens
+        else:
+            fits = token_length(symbol.get_substring().decode()) <= max_tokens
+        if cache is not None:
+            cache.fits_length[id(symbol)] = fits
+        return fits
 
     @classmethod
     def symbol_needs_indexing(
-        cls, symbol: IR.Symbol, kinds: List[SymbolKindName], max_tokens: int
+        cls,
+        symbol: IR.Symbol,
+        kinds: List[SymbolKindName],
+        max_tokens: int,
+        cache: Optional["Index.IndexingCache"] = None,
     ) -> bool:
+        if cache is not None and id(symbol) in cache.needs_indexing:
+            return cache.needs_indexing[id(symbol)]
         kind = symbol.symbol_kind
-        if kind.name() in kinds:
-            return True
-        elif isinstance(kind, IR.MetaSymbolKind):
-            if symbol.parent and not cls.symbol_fits_length(symbol.parent, max_tokens):
-                return True
-        return False
+        needs = False
+        if kind.NAME in kinds:
+            needs = True
+        elif kind.NAME in IR.META_KIND_NAMES:
+            if symbol.parent and not cls.symbol_fits_length(symbol.parent, max_tokens, cache):
+                needs = True
+        if cache is not None:
+            cache.needs_indexing[id(symbol)] = needs
+        return needs
 
     @classmethod
     def gather_nested_symbols(
-        cls, symbol: IR.Symbol, kinds: List[SymbolKindName], max_tokens: int
+        cls,
+        symbol: IR.Symbol,
+        kinds: List[SymbolKindName],
+        max_tokens: int,
+        cache: Optional["Index.IndexingCache"] = None,
     ) -> List["Index.EmbeddingItem"]:
         """Return references to documents in nested symbols"""
+        if cache is not None and id(symbol) in cache.nested_items:
+            return cache.nested_items[id(symbol)]
         items: List[Index.EmbeddingItem] = []
         for s in symbol.body:
-            if cls.symbol_needs_indexing(s, kinds, max_tokens):
+            if cls.symbol_needs_indexing(s, kinds, max_tokens, cache):
                 items.append(Index.ReferenceItem(s))
-                items.extend(cls.gather_nested_symbols(s, kinds, max_tokens))
+                items.extend(cls.gather_nested_symbols(s, kinds, max_tokens, cache))
+        if cache is not None:
+            cache.nested_items[id(symbol)] = items
         return items
 
     @classmethod
@@ -340,19 +916,23 @@ class Index:
         symbol: IR.Symbol,
         kinds: List[SymbolKindName],
         max_tokens: int,
+        cache: Optional["Index.IndexingCache"] = None,
     ) -> List["Index.EmbeddingItem"]:
         """Return documents for a symbol used for embedding"""
-        if not cls.symbol_needs_indexing(symbol, kinds, max_tokens):
+        if not cls.symbol_needs_indexing(symbol, kinds, max_tokens, cache):
             return []
-        if cls.symbol_fits_length(symbol, max_tokens):
-            return [Index.DocumentItem(symbol, symbol.get_substring().decode())]
+        if cls.symbol_fits_length(symbol, max_tokens, cache):
+            text = cache.texts.get(id(symbol)) if cache is not None else None
+            if text is None:
+                text = symbol.get_substring().decode()
+            return [Index.DocumentItem(symbol, text)]
         else:
             items: List[Index.EmbeddingItem] = []
 
             summary_doc = cls.get_summary_doc(symbol)
             if summary_doc:
                 items.append(summary_doc)
-            items.extend(cls.gather_nested_symbols(symbol, kinds, max_tokens))
+            items.extend(cls.gather_nested_symbols(symbol, kinds, max_tokens, cache))
 
             if debug:
                 print(
@@ -362,6 +942,28 @@ class Index:
 
             return items
 
+    @classmethod
+    def collect_file_documents(
+        cls, file: IR.File, kinds: List[SymbolKindName], max_tokens: int
+    ) -> List["Index.SymbolEmbedding"]:
+        """Return the symbols of a file to index, with the documents to embed for each."""
+        cache = Index.IndexingCache()
+        cache.add_token_lengths(file, max_tokens)
+        symbol_embeddings: List[Index.SymbolEmbedding] = []
+        for symbol in file.search_symbol(lambda _: True):
+            path_with_id = (file.path, symbol.get_qualified_id())
+            if cls.symbol_needs_indexing(symbol, kinds, max_tokens, cache):
+                items = cls.documents_for_symbol(file.path, symbol, kinds, max_tokens, cache)
+                if len(items) > 0:
+                    symbol_embeddings.append(
+                        Index.SymbolEmbedding(
+                            items=items,
+                            path_with_id=path_with_id,
+                            symbol=symbol,
+                        )
+                    )
+        return symbol_embeddings
+
     @classmethod
     async def create(
         cls,
@@ -375,6 +977,8 @@ class Index:
             "Theorem",
         ],
         max_tokens: int = MAX_TOKENS,
+        half_precision: bool = False,
+        processes: Optional[int] = None,
     ) -> "Index":
         """
         Creates an Index object from a given project and a function that returns embeddings for a given symbol.
@@ -382,45 +986,53 @@ class Index:
         Args:
             project: The project to index.
             kinds: The kinds of symbols to index.
+            half_precision: Whether to store the search matrix as float16.
+            processes: Number of worker processes collecting the documents to embed.
+                Defaults to one per CPU for projects of at least PARALLEL_MIN_FILES files.
 
         Returns:
             An Index object containing the embeddings for the symbols in the project.
         """
-        documents_to_embed: List["Index.DocumentItem"] = []
+        files = project.get_files()
+        if processes is None:
+            processes = NUM_THREADS if len(files) >= PARALLEL_MIN_FILES else 1
         symbol_embeddings: List["Index.SymbolEmbedding"] = []
+        if processes > 1:
+            chunksize = max(1, len(files) // (processes * 4))
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = executor.map(
+                    _collect_file_docs,
+                    files,
+                    [kinds] * len(files),
+                    [max_tokens] * len(files),
+                    chunksize=chunksize,
+                )
+                for file, collected in zip(files, results):
+                    symbol_embeddings.extend(_symbol_embeddings_from_worker(file, collected))
+        else:
+            for file in files:
+                symbol_embeddings.extend(cls.collect_file_documents(file, kinds, max_tokens))
+        documents_to_embed = [
+            item
+            for symbol_embedding in symbol_embeddings
+            for item in symbol_embedding.items
+            if isinstance(item, Index.DocumentItem)
+        ]
 
-        for file in project.get_files():
-            all_symbols = file.search_symbol(lambda _: True)
-            file_path = file.path
-            for symbol in all_symbols:
-                path_with_id = (file_path, symbol.get_qualified_id())
-                if cls.symbol_needs_indexing(symbol, kinds, max_tokens):
-                    items = cls.documents_for_symbol(file_path, symbol, kinds, max_tokens)
-                    if len(items) > 0:
-                        documents_to_embed.extend(
-                            [i for i in items if isinstance(i, Index.DocumentItem)]
-                        )
-                        symbol_embeddings.append(
-                            Index.SymbolEmbedding(
-                                items=items,
-                                path_with_id=path_with_id,
-                                symbol=symbol,
-                            )
-                        )
-
-        async def async_get_embedding(
-            document_to_embed: Index.DocumentItem,
-        ) -> Optional[Vector]:
-            return await openai_embedding(document_to_embed.document)
-
-        # Parallel server requests
-        embedded_results: List[Vector] = await asyncio.gather(
-            *(async_get_embedding(x) for x in documents_to_embed)
-        )
+        # Batched parallel server requests
+        embedded_results = await openai_embeddings([x.document for x in documents_to_embed])
 
-        # Assign embeddings
+        # Assign embeddings, as views of one matrix rather than an array per symbol
+        dim = next((len(v) for v in embedded_results if v is not None), 0)
+        matrix = np.zeros((len(embedded_results), dim), dtype=IR.EMBEDDING_DTYPE)
         for n, res in enumerate(embedded_results):
-            documents_to_embed[n].symbol.embedding = res
+            if res is not None:
+                matrix[n] = res
+                documents_to_embed[n].symbol.embedding = matrix[n]
+            else:
+                documents_to_embed[n].symbol.embedding = None
+        for file in files:
+            file.embeddings_changed()
 
         embeddings = {
             symbol_embedding.path_with_id: Embedding(
@@ -429,7 +1041,98 @@ class Index:
             )
             for symbol_embedding in symbol_embeddings
         }
-        return cls(embeddings=embeddings, project=project)
+        return cls(embeddings=embeddings, project=project, half_precision=half_precision)
+
+
+def _write_file(path: str, write: Callable[[IO[bytes]], Any]) -> None:
+    """Write a file next to `path` and move it into place. On failure, nothing is left behind."""
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    finally:
+        _remove_files([tmp])
+
+
+def _remove_files(paths: List[str]) -> None:
+    """Remove the files that exist. A file still open elsewhere may not be removable."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Cannot remove {path}: {e}")
+
+
+def _saved_id(path: str) -> Optional[str]:
+    """Return the `save_id` of the index saved at `path`, if any."""
+    try:
+        with open(path + META_SUFFIX, "rb") as f:
+            return json.load(f)["save_id"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# (symbol, [(item symbol, document or None for a reference)]), symbols given by number
+CollectedDocs = List[Tuple[int, List[Tuple[int, Optional[str]]]]]
+
+
+def _file_symbols(file: IR.File) -> List[IR.Symbol]:
+    """Return all the symbols of a file, numbered in the same way in every process."""
+    symbols = file.search_symbol(lambda _: True)
+    seen = set(id(symbol) for symbol in symbols)
+    stack = [file.symbol] if file.symbol else []
+    while stack:
+        symbol = stack.pop()
+        if id(symbol) not in seen:
+            seen.add(id(symbol))
+            symbols.append(symbol)
+        stack.extend(reversed(symbol.body))
+    return symbols
+
+
+def _collect_file_docs(
+    file: IR.File, kinds: List[SymbolKindName], max_tokens: int
+) -> CollectedDocs:
+    """Run Index.collect_file_documents in a worker process, on a copy of the file."""
+    numbers = {id(symbol): n for n, symbol in enumerate(_file_symbols(file))}
+    return [
+        (
+            numbers[id(symbol_embedding.symbol)],
+            [
+                (
+                    numbers[id(item.symbol)],
+                    item.document if isinstance(item, Index.DocumentItem) else None,
+                )
+                for item in symbol_embedding.items
+            ],
+        )
+        for symbol_embedding in Index.collect_file_documents(file, kinds, max_tokens)
+    ]
+
+
+def _symbol_embeddings_from_worker(
+    file: IR.File, collected: CollectedDocs
+) -> List[Index.SymbolEmbedding]:
+    """Map the output of _collect_file_docs back to the symbols of `file`."""
+    symbols = _file_symbols(file)
+    return [
+        Index.SymbolEmbedding(
+            items=[
+                (
+                    Index.ReferenceItem(symbols[m])
+                    if document is None
+                    else Index.DocumentItem(symbols[m], document)
+                )
+                for m, document in items
+            ],
+            path_with_id=(file.path, symbols[n].get_qualified_id()),
+            symbol=symbols[n],
+        )
+        for n, items in collected
+    ]
 
 
 @pytest.mark.asyncio
@@ -495,7 +1198,7 @@ async def test_index() -> None:
     # in_class = Function(in_class_function)
 
     test_search(
-        Text(
+        await Text.aembed(
             "Warning: symbol '{symbol.get_qualified_id()}' is too long ({len(symbol.get_substring().decode())} > {max_len}"
         ),
         # ["Function", "Class"],
@@ -5,18 +5,21 @@ import time
 from typing import List, Optional
 
 import git
+import numpy as np
 import rich
 from rich.console import Console
 from rich.markdown import Markdown
 
 import mci.ir.IR as IR
-from mci.index.index import Index, PathWithId, Query, Text
+from mci.index import embed_cache
+from mci.index.index import EMBEDDING_MODEL, Index, PathWithId, Query, Text
 from mci.ir.parser import parse_files_in_paths
 
 repo_root = git.Repo(".", search_parent_directories=True).git.rev_parse("--show-toplevel")
 morph_dir = os.path.join(repo_root, ".morph")
 os.makedirs(morph_dir, exist_ok=True)
 index_file = os.path.join(morph_dir, "index.rci")
+query_cache_dir = os.path.join(morph_dir, "query_cache")
 
 from dataclasses import dataclass
 
@@ -45,6 +48,19 @@ class MorphSearchResult:
 ```"""
 
 
+def embed_query(query_str: str) -> Text:
+    """Embed a search query, reusing the vector saved by a previous search for the same string."""
+    key = embed_cache.cache_key(EMBEDDING_MODEL, query_str).hex()
+    cache_file = os.path.join(query_cache_dir, key + ".npy")
+    if os.path.exists(cache_file):
+        return Text(query_str, vector=np.load(cache_file))
+    text = Text(query_str)
+    if hasattr(text, "vector"):
+        os.makedirs(query_cache_dir, exist_ok=True)
+        np.save(cache_file, text.vector)
+    return text
+
+
 def search(args):
     TOP_N = 8
     # Load the index
@@ -55,7 +71,7 @@ def search(args):
 
     # Create a query from the command line arguments
     query_str = " ".join(args)
-    query = Query(Text(query_str), num_results=TOP_N)
+    query = Query(embed_query(query_str), num_results=TOP_N)
 
     header = f"""\
 # Morph Code Index
@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+
+from .embed_cache import EmbeddingCache, cache_key
+
+
+def test_embedding_cache(tmp_path: str):
+    cache_dir = os.path.join(tmp_path, "embeddings")
+    key = cache_key("model", "def foo(): pass")
+    assert key != cache_key("other-model", "def foo(): pass")
+    vector = np.arange(4, dtype=np.float32)
+
+    cache = EmbeddingCache(cache_dir)
+    assert cache.get(key) is None
+    cache.put(key, vector)
+    cached = cache.get(key)
+    assert cached is not None and cached.dtype == np.float32
+    assert np.array_equal(cached, vector)
+    cached[0] = 100  # callers get their own copy
+    assert np.array_equal(cache.get(key), vector)
+
+    # persisted across instances
+    reopened = EmbeddingCache(cache_dir, memory_size=1)
+    assert np.array_equal(reopened.get(key), vector)
+    other = cache_key("model", "def bar(): pass")
+    reopened.put(other, vector + 1)
+    assert len(reopened._memory) == 1
+    assert np.array_equal(reopened.get(key), vector)
+
+
+def test_put_many(tmp_path: str):
+    cache_dir = os.path.join(tmp_path, "embeddings")
+    keys = [cache_key("model", f"def f{n}(): pass") for n in range(3)]
+    vectors = [np.full(4, n, dtype=np.float32) for n in range(3)]
+    cache = EmbeddingCache(cache_dir)
+    cache.put_many(list(zip(keys, vectors)))
+    cache.put_many([])
+    reopened = EmbeddingCache(cache_dir)
+    for key, vector in zip(keys, vectors):
+        assert np.array_equal(reopened.get(key), vector)
+
+    # database errors are logged, and the lookup misses
+    reopened._memory.clear()
+    assert reopened._db is not None
+    reopened._db.close()
+    assert reopened.get(keys[0]) is None
+    reopened.put(keys[0], vectors[0])  # kept in memory
+    assert np.array_equal(reopened.get(keys[0]), vectors[0])
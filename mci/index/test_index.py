@@ -0,0 +1,302 @@
+import os
+import pickle
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pytest
+
+from ..ir import IR, test_parser
+from . import embed_cache, index
+from .index import And, Embedding, Function, Index, Not, Or, PathWithId, Query, Text
+
+DIM = 16
+openai_embedding_sync = index.openai_embedding_sync  # before the fixture replaces it
+
+
+def random_vector(seed: str) -> IR.Vector:
+    rng = np.random.default_rng(zlib.crc32(seed.encode()))
+    return index.normalize(rng.standard_normal(DIM).astype(np.float32))
+
+
+batch_sizes: List[int] = []
+
+
+@pytest.fixture(autouse=True)
+def offline_embeddings(monkeypatch: pytest.MonkeyPatch, tmp_path: str) -> None:
+    """Replace the OpenAI embedding calls with deterministic random vectors."""
+
+    def fake_embedding(document: str) -> Optional[IR.Vector]:
+        return random_vector(document)
+
+    async def fake_embedding_batch(texts: List[str]) -> List[Optional[IR.Vector]]:
+        batch_sizes.append(len(texts))
+        return [random_vector(text) for text in texts]
+
+    monkeypatch.setattr(index, "openai_embedding_sync", fake_embedding)
+    monkeypatch.setattr(index, "openai_embedding_batch", fake_embedding_batch)
+    cache = embed_cache.EmbeddingCache(os.path.join(tmp_path, "embeddings"))
+    monkeypatch.setattr(embed_cache, "_cache", cache)
+    batch_sizes.clear()
+
+
+def get_test_index(half_precision: bool = False) -> Index:
+    project = test_parser.get_test_python_project()
+    embeddings: Dict[PathWithId, Embedding] = {}
+    for file in project.get_files():
+        for symbol in file.search_symbol(lambda _: True):
+            symbol.embedding = random_vector(symbol.get_qualified_id())
+        for symbol in file.search_symbol(lambda _: True):
+            # aggregate the nested symbols, as done for symbols that are too long
+            embeddings[(file.path, symbol.get_qualified_id())] = Embedding(
+                symbol=symbol, aggregate_symbols=[symbol] + list(symbol.body)
+            )
+    return Index(embeddings=embeddings, project=project, half_precision=half_precision)
+
+
+def reference_search(idx: Index, query: Query) -> List[Tuple[PathWithId, float]]:
+    scores = [
+        (path_with_id, e.similarity(query=query))
+        for path_with_id, e in idx.embeddings.items()
+        if e.symbol.symbol_kind.name() in query.kinds
+    ]
+    scores = sorted(scores, key=lambda x: x[1], reverse=True)
+    return scores[: query.num_results]
+
+
+def check_search(idx: Index, query: Query) -> None:
+    results = idx.search(query)
+    expected = reference_search(idx, query)
+    # the order of (near) ties depends on float rounding, so compare the scores
+    assert [score for _, score, _ in results] == pytest.approx([s for _, s in expected], abs=1e-5)
+    for path_with_id, score, symbol in results:
+        assert symbol is idx.embeddings[path_with_id].symbol
+        assert score == pytest.approx(idx.embeddings[path_with_id].similarity(query), abs=1e-5)
+
+
+def test_search():
+    idx = get_test_index()
+    kinds: List[IR.SymbolKindName] = ["Function", "Class", "If", "Body", "Guard"]
+    check_search(idx, Query(Text("load"), num_results=5, kinds=kinds))
+    check_search(idx, Query(Text("load"), num_results=1000, kinds=kinds))
+    check_search(idx, Query(Text("load"), num_results=3, kinds=["Function"]))
+    check_search(idx, Query(And(Text("load"), Not(Text("save"))), num_results=5, kinds=kinds))
+    check_search(idx, Query(Or([Text("load"), Text("save")]), num_results=5, kinds=kinds))
+    nested = Function(lambda symbol: len(symbol.body) / 10)
+    check_search(idx, Query(Or(Not(Text("load")), nested), num_results=5, kinds=kinds))
+    check_search(idx, Query(nested, num_results=5, kinds=kinds))
+    load = Text("load")
+    query = Query(And([Or(load, Text("save")), Not(load)]), num_results=5, kinds=kinds)
+    assert query.leaf_vectors.shape == (2, DIM)  # the same leaf is scored once
+    check_search(idx, query)
+    assert idx.search(Query(Text("load"), num_results=5, kinds=["Theorem"])) == []
+    assert idx.search(Query(Text("load"), num_results=0, kinds=kinds)) == []
+
+
+def test_search_half_precision():
+    idx = get_test_index(half_precision=True)
+    assert idx._E.dtype == np.float16
+    idx.UPCAST_BLOCK = 7  # exercise the blocked upcast on a small index
+    query = Query(Text("load"), num_results=1000, kinds=["Function", "Class", "If", "Body"])
+    results = idx.search(query)
+    assert len(results) == len(reference_search(idx, query))
+    for path_with_id, score, _ in results:
+        assert score == pytest.approx(idx.embeddings[path_with_id].similarity(query), abs=1e-2)
+
+
+@pytest.mark.asyncio
+async def test_create(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(index, "EMBEDDING_BATCH_SIZE", 4)
+    project = test_parser.get_test_python_project()
+    idx = await Index.create(project=project, max_tokens=20)
+    assert len(idx.embeddings) > 0
+    for e in idx.embeddings.values():
+        assert any(symbol.embedding is not None for symbol in e.aggregate_symbols)
+    assert batch_sizes and max(batch_sizes) <= 4
+    # all the embeddings are views of a single matrix
+    vectors = [s.embedding for s in idx._rows if s.embedding is not None]
+    assert len(set(id(v.base) for v in vectors)) == 1
+    check_search(idx, Query(Text("load"), num_results=5, kinds=["Function", "Class"]))
+    query = random_vector("load")
+    for file in project.get_files():
+        symbols, _matrix = file.embedding_matrix()
+        expected = [s.embedding @ query / np.linalg.norm(s.embedding) for s in symbols]
+        assert file.batched_cosine(query) == pytest.approx(expected, abs=1e-5)
+
+    # documents are embedded from the cache the second time
+    batch_sizes.clear()
+    await Index.create(project=test_parser.get_test_python_project(), max_tokens=20)
+    assert batch_sizes == []
+
+
+@pytest.mark.asyncio
+async def test_create_half_embeddings(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(IR, "EMBEDDING_DTYPE", np.float16)
+    idx = await Index.create(project=test_parser.get_test_python_project(), max_tokens=20)
+    vectors = [s.embedding for s in idx._rows if s.embedding is not None]
+    assert vectors and all(v.dtype == np.float16 for v in vectors)
+    assert idx._E.dtype == np.float32
+    query = Query(Text("load"), num_results=1000, kinds=["Function", "Class"])
+    for path_with_id, score, _ in idx.search(query):
+        assert score == pytest.approx(idx.embeddings[path_with_id].similarity(query), abs=1e-2)
+
+
+def test_symbol_fits_length(monkeypatch: pytest.MonkeyPatch):
+    project = test_parser.get_test_python_project()
+    symbols = [s for file in project.get_files() for s in file.search_symbol(lambda _: True)]
+    max_tokens = max(len(s.get_substring()) for s in symbols)
+    expected = [index.token_length(s.get_substring().decode()) <= 10 for s in symbols]
+    assert [Index.symbol_fits_length(s, 10) for s in symbols] == expected
+
+    def no_encoding(string: str) -> int:
+        raise AssertionError("symbols that are short in bytes are not encoded")
+
+    monkeypatch.setattr(index, "token_length", no_encoding)
+    assert all(Index.symbol_fits_length(s, max_tokens) for s in symbols)
+
+
+@pytest.mark.asyncio
+async def test_create_processes():
+    def documents(idx: Index) -> List[List[str]]:
+        return [
+            [symbol.get_qualified_id() for symbol in e.aggregate_symbols]
+            for e in idx.embeddings.values()
+        ]
+
+    idx = await Index.create(project=test_parser.get_test_python_project(), max_tokens=20)
+    parallel = await Index.create(
+        project=test_parser.get_test_python_project(), max_tokens=20, processes=2
+    )
+    assert list(parallel.embeddings) == list(idx.embeddings)
+    assert documents(parallel) == documents(idx)
+    # the documents are mapped back to the symbols of the project, not copies from the workers
+    symbols = set(
+        id(symbol)
+        for file in parallel.project.get_files()
+        for symbol in file.search_symbol(lambda _: True)
+    )
+    for e in parallel.embeddings.values():
+        assert all(id(symbol) in symbols for symbol in [e.symbol] + e.aggregate_symbols)
+
+
+@pytest.mark.asyncio
+async def test_asearch():
+    idx = get_test_index()
+    kinds: List[IR.SymbolKindName] = ["Function", "Class"]
+    results = await idx.asearch("load", num_results=3, kinds=kinds)
+    assert results == idx.search(Query(Text("load"), num_results=3, kinds=kinds))
+    query = Query(Or(await Text.aembed("load"), await Text.aembed("save")), kinds=kinds)
+    check_search(idx, query)
+    assert await idx.asearch(query) == idx.search(query)
+    assert batch_sizes  # embedded with the async API
+    with pytest.raises(RuntimeError):
+        openai_embedding_sync("load")  # would block the event loop
+
+
+@pytest.mark.asyncio
+async def test_asearch_failed_embedding(monkeypatch: pytest.MonkeyPatch):
+    idx = get_test_index()
+    kinds: List[IR.SymbolKindName] = ["Function", "Class"]
+    save = await Text.aembed("save")
+
+    async def failed_embedding_batch(texts: List[str]) -> List[Optional[IR.Vector]]:
+        return [None] * len(texts)
+
+    monkeypatch.setattr(index, "openai_embedding_batch", failed_embedding_batch)
+    failed = await Text.aembed("load")
+    assert len(failed.vector) == 0
+    results = await idx.asearch("load", num_results=3, kinds=kinds)
+    assert len(results) == 3 and all(score == 0.0 for _, score, _ in results)
+    # a failed leaf scores 0 next to an embedded one
+    check_search(idx, Query(Or(failed, save), num_results=5, kinds=kinds))
+    check_search(idx, Query(And(Not(failed), save), num_results=5, kinds=kinds))
+
+
+def data_prefix(path: str) -> str:
+    return f"{path}.{index._saved_id(path)}"
+
+
+def test_save_load(tmp_path: str, monkeypatch: pytest.MonkeyPatch):
+    directory = os.path.join(tmp_path, "index")  # apart from the embedding cache
+    os.mkdir(directory)
+    path = os.path.join(directory, "index.mci")
+    for half_precision in [False, True]:
+        idx = get_test_index(half_precision=half_precision)
+        idx.save(path)
+        prefix = data_prefix(path)
+        suffixes = [index.ROWS_SUFFIX, index.VECS_SUFFIX, index.PROJECT_SUFFIX]
+        assert os.path.exists(path + index.META_SUFFIX)
+        assert all(os.path.exists(prefix + suffix) for suffix in suffixes)
+        loaded = Index.load(path)
+        assert loaded._E.dtype == idx._E.dtype
+        if not half_precision:
+            assert isinstance(loaded._E, np.memmap)
+        query = Query(Text("load"), num_results=5, kinds=["Function", "Class"])
+        assert [r[0] for r in loaded.search(query)] == [r[0] for r in idx.search(query)]
+        assert list(loaded.embeddings) == list(idx.embeddings)
+        loaded_symbols = set(
+            id(symbol)
+            for file in loaded.project.get_files()
+            for symbol in index._file_symbols(file)
+        )
+        for path_with_id, e in idx.embeddings.items():
+            loaded_e = loaded.embeddings[path_with_id]
+            assert [s.get_qualified_id() for s in loaded_e.aggregate_symbols] == [
+                s.get_qualified_id() for s in e.aggregate_symbols
+            ]
+            assert np.allclose(loaded_e.symbol.embedding, e.symbol.embedding, atol=1e-6)
+            assert all(id(symbol) in loaded_symbols for symbol in loaded_e.aggregate_symbols)
+
+        unpickled = pickle.loads(pickle.dumps(loaded))
+        assert list(unpickled.embeddings) == list(idx.embeddings)
+        assert [r[0] for r in unpickled.search(query)] == [r[0] for r in idx.search(query)]
+
+        # saving over the memory-mapped files leaves the loaded index intact
+        loaded.save(path)
+        assert [r[0] for r in loaded.search(query)] == [
+            r[0] for r in Index.load(path).search(query)
+        ]
+        # and removes the files of the previous save
+        assert not any(os.path.exists(prefix + suffix) for suffix in suffixes)
+        assert len(os.listdir(directory)) == 4
+
+        # compressed, decompressed on the first load
+        idx.save(path, compress=True)
+        prefix = data_prefix(path)
+        assert not os.path.exists(prefix + index.VECS_SUFFIX)
+        assert [r[0] for r in Index.load(path).search(query)] == [r[0] for r in idx.search(query)]
+        assert os.path.exists(prefix + index.VECS_SUFFIX)
+        assert Index.load(path)._E.dtype == idx._E.dtype
+
+        # files of different saves are not mixed
+        os.replace(prefix + index.ROWS_SUFFIX, path + ".rows")
+        idx.save(path)
+        os.replace(path + ".rows", data_prefix(path) + index.ROWS_SUFFIX)
+        with pytest.raises(ValueError):
+            Index.load(path)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+    # a save that fails midway leaves the previous save readable, and no files of its own
+    idx = get_test_index()
+    idx.save(path)
+    files = sorted(os.listdir(directory))
+    query = Query(Text("load"), num_results=5, kinds=["Function", "Class"])
+
+    def failed_savez(*args: Any, **kwargs: Any) -> None:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(np, "savez", failed_savez)
+    with pytest.raises(OSError, match="disk full"):
+        get_test_index().save(path)
+    assert sorted(os.listdir(directory)) == files
+    assert [r[0] for r in Index.load(path).search(query)] == [r[0] for r in idx.search(query)]
+
+    # an index in the old single pickle format
+    old_path = os.path.join(tmp_path, "old.rci")
+    with open(old_path, "wb") as f:
+        pickle.dump({"version": "0.0.6"}, f)
+    with pytest.raises(ValueError, match="morph index"):
+        Index.load(old_path)
+    with pytest.raises(FileNotFoundError):
+        Index.load(os.path.join(tmp_path, "missing.rci"))
@@ -1,8 +1,12 @@
+import operator
 import os
-from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
-from typing import Callable, Dict, List, Literal, Optional, Tuple, Union
+import sys
+import weakref
+from abc import ABC
+from dataclasses import dataclass, field, fields
+from typing import Any, Callable, ClassVar, Dict, FrozenSet, List, Literal, Optional, Tuple, Union
 
+import msgspec
 import numpy as np
 import numpy.typing as npt
 
@@ -28,32 +32,81 @@ Pos = Tuple[int, int]  # (line, column)
 Range = Tuple[Pos, Pos]  # ((start_line, start_column), (end_line, end_column))
 Substring = Tuple[int, int]  # (start_byte, end_byte)
 Scope = str  # e.g. "A.B." for class B inside class A
-Vector = npt.NDArray[np.float32]  # for embeddings
+Vector = npt.NDArray[np.floating[Any]]  # for embeddings
 
+# dtype the embeddings of symbols are stored in: np.float16 halves their memory, and the
+# similarities are still computed in float32
+EMBEDDING_DTYPE: npt.DTypeLike = np.float32
 
-@dataclass
+
+@dataclass(slots=True)
 class Code:
     bytes: bytes
+    _newlines: Optional[npt.NDArray[np.intp]] = field(default=None, repr=False, compare=False)
 
     def __str__(self):
         return self.bytes.decode()
 
     __repr__ = __str__
 
-    def apply_edit(self, edit: "CodeEdit") -> "Code":
-        return edit.apply(self)
+    def __getstate__(self) -> bytes:
+        return self.bytes  # the newlines are found again when needed
 
-    def apply_edits(self, edits: List["CodeEdit"]) -> "Code":
-        code = self
-        # sort the edits in descending order of their start position
-        edits.sort(key=lambda x: -x.substring[0])
-        for edit in edits:
-            code = code.apply_edit(edit)
-        return code
+    def __setstate__(self, state: bytes) -> None:
+        self.bytes = state
+        self._newlines = None
 
+    def newlines(self) -> npt.NDArray[np.intp]:
+        """Returns the sorted byte offsets of the newlines, found in one pass on first use."""
+        if self._newlines is None:
+            self._newlines = np.flatnonzero(np.frombuffer(self.bytes, dtype=np.uint8) == ord("\n"))
+        return self._newlines
 
-@dataclass
-class CodeEdit:
+    def line_start(self, line: int) -> int:
+        """Returns the byte offset of the start of a line, counted from 0."""
+        return 0 if line == 0 else int(self.newlines()[line - 1]) + 1
+
+    def pos_of_offset(self, offset: int) -> Pos:
+        """Returns the (line, column) of a byte offset, with a binary search on the newlines."""
+        line = int(np.searchsorted(self.newlines(), offset))
+        return (line, offset - self.line_start(line))
+
+    def offset_of_pos(self, pos: Pos) -> int:
+        """Returns the byte offset of a (line, column) position."""
+        line, column = pos
+        return self.line_start(line) + column
+
+    def apply_edit(self, edit: "CodeEdit") -> "Code":
+        return edit.apply(self)
+
+    def apply_edits(
+        self, edits: List["CodeEdit"], assume_sorted: Literal["asc", "desc", None] = None
+    ) -> "Code":
+        """
+        Apply non-overlapping edits. If the edits are already sorted by substring, in ascending
+        or descending order, pass `assume_sorted` to skip sorting them; otherwise they are
+        sorted in place in descending order.
+        """
+        if assume_sorted is None:
+            edits.sort(key=operator.attrgetter("substring"), reverse=True)
+        # join the unchanged slices and the new bytes in ascending order, copying the code once;
+        # edits with the same substring end up in the order of applying them one by one from the end
+        ascending = edits if assume_sorted == "asc" else reversed(edits)
+        view = memoryview(self.bytes)
+        parts: List[Union[bytes, memoryview]] = []
+        cur = 0
+        for edit in ascending:
+            start, end = edit.substring
+            if start < cur:
+                raise ValueError(f"Overlapping or unsorted edit at {edit.substring}")
+            parts.append(view[cur:start])
+            parts.append(edit.new_bytes)
+            cur = end
+        parts.append(view[cur:])
+        return Code(b"".join(parts))
+
+
+class CodeEdit(msgspec.Struct, gc=False):
     substring: Substring
     new_bytes: bytes
 
@@ -76,8 +129,7 @@ class Block(List["Symbol"]):
         return self.__str__()
 
 
-@dataclass
-class Case:
+class Case(msgspec.Struct):
     guard: "Symbol"
     body: "Symbol"
 
@@ -88,20 +140,18 @@ class Case:
         return self.__str__()
 
 
-@dataclass
-class Import:
+class Import(msgspec.Struct, gc=False):
     names: List[str]  # import foo, bar, baz
     substring: Substring  # the substring of the document that corresponds to this import
     module_name: Optional[str] = None  # from module_name import ...
 
 
-@dataclass
-class Type:
+class Type(msgspec.Struct, gc=False):
     kind: Literal[
         "array", "constructor", "function", "pointer", "record", "reference", "type_of", "unknown"
     ]
-    arguments: List["Type"] = field(default_factory=list)
-    fields: List["Field"] = field(default_factory=list)
+    arguments: List["Type"] = msgspec.field(default_factory=list)
+    fields: List["Field"] = msgspec.field(default_factory=list)
     name: Optional[str] = None
 
     def array(self) -> "Type":
@@ -134,33 +184,26 @@ class Type:
         return Type(kind="unknown", name=s)
 
     def __str__(self) -> str:
-        if self.kind == "array":
-            return f"{self.arguments[0]}[]"
-        elif self.kind == "constructor":
-            if self.arguments != []:
-                return f"{self.name}<{', '.join([str(arg) for arg in self.arguments])}>"
-            else:
-                return self.name or "unknown"
-        elif self.kind == "function":
-            return f"{self.arguments[0]}()"
-        elif self.kind == "pointer":
-            return f"{self.arguments[0]}*"
-        elif self.kind == "record":
-            return f"{{{', '.join([str(field) for field in self.fields])}}}"
-        elif self.kind == "reference":
-            return f"{self.arguments[0]}&"
-        elif self.kind == "type_of":
-            return f"typeof({self.arguments[0]})"
-        elif self.kind == "unknown":
-            return self.name or "unknown"
-        else:
-            raise Exception(f"Unknown type kind: {self.kind}")
+        # emit the string pieces from a stack instead of recursing on the arguments
+        out: List[str] = []
+        stack: List[Union[str, Type]] = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            format = _TYPE_FORMAT.get(item.kind)
+            if format is None:
+                raise Exception(f"Unknown type kind: {item.kind}")
+            pieces = format(item)
+            pieces.reverse()
+            stack.extend(pieces)
+        return "".join(out)
 
     __repr__ = __str__
 
 
-@dataclass
-class Field:
+class Field(msgspec.Struct, gc=False):
     name: str
     optional: bool
     type: Type
@@ -175,8 +218,61 @@ class Field:
     __repr__ = __str__
 
 
-@dataclass
-class Parameter:
+TypePieces = List[Union[str, Type]]
+
+
+def _format_suffix(suffix: str) -> Callable[[Type], TypePieces]:
+    def format(t: Type) -> TypePieces:
+        return [t.arguments[0], suffix]
+
+    return format
+
+
+def _format_constructor(t: Type) -> TypePieces:
+    if t.arguments == []:
+        return [t.name or "unknown"]
+    pieces: TypePieces = [f"{t.name}<"]
+    for i, arg in enumerate(t.arguments):
+        if i > 0:
+            pieces.append(", ")
+        pieces.append(arg)
+    pieces.append(">")
+    return pieces
+
+
+def _format_record(t: Type) -> TypePieces:
+    pieces: TypePieces = ["{"]
+    for i, field in enumerate(t.fields):
+        if i > 0:
+            pieces.append(", ")
+        pieces.append(f"{field.name}?: " if field.optional else f"{field.name}: ")
+        pieces.append(field.type)
+    pieces.append("}")
+    return pieces
+
+
+def _format_type_of(t: Type) -> TypePieces:
+    return ["typeof(", t.arguments[0], ")"]
+
+
+def _format_unknown(t: Type) -> TypePieces:
+    return [t.name or "unknown"]
+
+
+# the pieces of the string of a type, by kind, with the nested types left to format
+_TYPE_FORMAT: Dict[str, Callable[[Type], TypePieces]] = {
+    "array": _format_suffix("[]"),
+    "constructor": _format_constructor,
+    "function": _format_suffix("()"),
+    "pointer": _format_suffix("*"),
+    "record": _format_record,
+    "reference": _format_suffix("&"),
+    "type_of": _format_type_of,
+    "unknown": _format_unknown,
+}
+
+
+class Parameter(msgspec.Struct, gc=False):
     name: str
     default_value: Optional[str] = None
     type: Optional[Type] = None
@@ -217,13 +313,14 @@ SymbolKindName = Literal[
 ]
 
 
-@dataclass
+@dataclass(slots=True)
 class SymbolKind(ABC):
-    """Abstract class for symbol kinds."""
+    """Abstract class for symbol kinds. Each concrete kind sets its name in NAME."""
+
+    NAME: ClassVar[SymbolKindName]
 
-    @abstractmethod
     def name(self) -> SymbolKindName:
-        raise NotImplementedError
+        return self.NAME
 
     def dump(self, lines: List[str]) -> None:
         pass
@@ -232,7 +329,7 @@ class SymbolKind(ABC):
         return None
 
 
-@dataclass
+@dataclass(slots=True)
 class MetaSymbolKind(SymbolKind):
     """
     Represents a synthetic or structural symbol in the program.
@@ -246,7 +343,7 @@ class MetaSymbolKind(SymbolKind):
     pass
 
 
-@dataclass
+@dataclass(slots=True)
 class BodyKind(MetaSymbolKind):
     """Represents the body of a branch in the intermediate representation (IR).
 
@@ -256,8 +353,7 @@ class BodyKind(MetaSymbolKind):
 
     block: Block
 
-    def name(self) -> SymbolKindName:
-        return "Body"
+    NAME: ClassVar[SymbolKindName] = "Body"
 
     def dump(self, lines: List[str]) -> None:
         lines.append(f"   block: {self.block}")
@@ -269,7 +365,7 @@ class BodyKind(MetaSymbolKind):
         return self.__str__()
 
 
-@dataclass
+@dataclass(slots=True)
 class CallKind(MetaSymbolKind):
     """
     Represents a function call in the intermediate representation (IR) of the Rift engine.
@@ -278,8 +374,7 @@ class CallKind(MetaSymbolKind):
     function_name: str
     arguments: List[Expression]
 
-    def name(self) -> SymbolKindName:
-        return "Call"
+    NAME: ClassVar[SymbolKindName] = "Call"
 
     def dump(self, lines: List[str]) -> None:
         lines.append(f"   function_name: {self.function_name}")
@@ -293,7 +388,7 @@ class CallKind(MetaSymbolKind):
         return self.__str__()
 
 
-@dataclass
+@dataclass(slots=True)
 class ClassKind(SymbolKind):
     """
     Represents a class in the program's intermediate representation.
@@ -301,25 +396,23 @@ class ClassKind(SymbolKind):
 
     superclasses: Optional[str]
 
-    def name(self) -> SymbolKindName:
-        return "Class"
+    NAME: ClassVar[SymbolKindName] = "Class"
 
     def signature(self) -> Optional[str]:
         if self.superclasses is not None:
             return self.superclasses
 
 
-@dataclass
+@dataclass(slots=True)
 class DefKind(SymbolKind):
     """
     Represents a mathematical definition in Lean: https://leanprover.github.io/lean4/doc/definitions.html
     """
 
-    def name(self) -> SymbolKindName:
-        return "Def"
+    NAME: ClassVar[SymbolKindName] = "Def"
 
 
-@dataclass
+@dataclass(slots=True)
 class ExpressionKind(MetaSymbolKind):
     """Represents an expression statement in the intermediate representation (IR) of the Rift engine.
 
@@ -329,8 +422,7 @@ class ExpressionKind(MetaSymbolKind):
 
     code: str
 
-    def name(self) -> SymbolKindName:
-        return "Expression"
+    NAME: ClassVar[SymbolKindName] = "Expression"
 
     def dump(self, lines: List[str]) -> None:
         lines.append(f"   code: {self.code}")
@@ -342,17 +434,16 @@ class ExpressionKind(MetaSymbolKind):
         return self.__str__()
 
 
-@dataclass
+@dataclass(slots=True)
 class FileKind(MetaSymbolKind):
     """
     Represents a file in the IR.
     """
 
-    def name(self) -> SymbolKindName:
-        return "File"
+    NAME: ClassVar[SymbolKindName] = "File"
 
 
-@dataclass
+@dataclass(slots=True)
 class FunctionKind(SymbolKind):
     """Represents a function symbol in the intermediate representation (IR) of the Rift engine.
 
@@ -366,8 +457,7 @@ class FunctionKind(SymbolKind):
     parameters: List[Parameter]
     return_type: Optional[Type] = None
 
-    def name(self) -> SymbolKindName:
-        return "Function"
+    NAME: ClassVar[SymbolKindName] = "Function"
 
     def dump(self, lines: List[str]) -> None:
         if self.parameters != []:
@@ -378,14 +468,13 @@ class FunctionKind(SymbolKind):
             lines.append(f"   has_return: {self.has_return}")
 
 
-@dataclass
+@dataclass(slots=True)
 class GuardKind(MetaSymbolKind):
     """Guard of a conditional"""
 
     condition: Expression
 
-    def name(self) -> SymbolKindName:
-        return "Guard"
+    NAME: ClassVar[SymbolKindName] = "Guard"
 
     def dump(self, lines: List[str]) -> None:
         lines.append(f"   condition: {self.condition}")
@@ -397,7 +486,7 @@ class GuardKind(MetaSymbolKind):
         return self.__str__()
 
 
-@dataclass
+@dataclass(slots=True)
 class IfKind(MetaSymbolKind):
     """A symbol kind representing an if statement.
 
@@ -411,8 +500,7 @@ class IfKind(MetaSymbolKind):
     elif_cases: List[Case]
     else_body: Optional["Symbol"]
 
-    def name(self) -> SymbolKindName:
-        return "If"
+    NAME: ClassVar[SymbolKindName] = "If"
 
     def dump(self, lines: List[str]) -> None:
         lines.append(f"   if_case: {self.if_case}")
@@ -433,65 +521,59 @@ class IfKind(MetaSymbolKind):
         return self.__str__()
 
 
-@dataclass
+@dataclass(slots=True)
 class InterfaceKind(SymbolKind):
     """
     Represents a kind of symbol that defines an interface.
     """
 
-    def name(self) -> SymbolKindName:
-        return "Interface"
+    NAME: ClassVar[SymbolKindName] = "Interface"
 
 
-@dataclass
+@dataclass(slots=True)
 class ModuleKind(SymbolKind):
     """
     Represents a module in the IR.
     """
 
-    def name(self) -> SymbolKindName:
-        return "Module"
+    NAME: ClassVar[SymbolKindName] = "Module"
 
 
-@dataclass
+@dataclass(slots=True)
 class NamespaceKind(SymbolKind):
     """
     Represents a namespace in the IR.
     """
 
-    def name(self) -> SymbolKindName:
-        return "Namespace"
+    NAME: ClassVar[SymbolKindName] = "Namespace"
 
 
-@dataclass
+@dataclass(slots=True)
 class SectionKind(SymbolKind):
     """Represents a Lean section: https://leanprover.github.io/lean4/doc/sections.html"""
 
-    def name(self) -> SymbolKindName:
-        return "Section"
+    NAME: ClassVar[SymbolKindName] = "Section"
 
 
-@dataclass
+@dataclass(slots=True)
 class StructureKind(SymbolKind):
     """
     Represents a structure in Lean: https://lean-lang.org/lean4/doc/struct.html
     """
 
-    def name(self) -> SymbolKindName:
-        return "Structure"
+    NAME: ClassVar[SymbolKindName] = "Structure"
 
 
-@dataclass
+@dataclass(slots=True)
 class TheoremKind(SymbolKind):
     """
     Represents a theorem in Lean: https://lean-lang.org/theorem_proving_in_lean4/title_page.html
     """
 
-    def name(self) -> SymbolKindName:
-        return "Theorem"
+    NAME: ClassVar[SymbolKindName] = "Theorem"
 
 
-@dataclass
+@dataclass(slots=True)
 class TypeDefinitionKind(SymbolKind):
     """
     Represents a type definition in the IR.
@@ -499,8 +581,7 @@ class TypeDefinitionKind(SymbolKind):
 
     type: Optional[Type] = None
 
-    def name(self) -> SymbolKindName:
-        return "TypeDefinition"
+    NAME: ClassVar[SymbolKindName] = "TypeDefinition"
 
     def dump(self, lines: List[str]) -> None:
         if self.type is not None:
@@ -508,22 +589,21 @@ class TypeDefinitionKind(SymbolKind):
 
     def __str__(self) -> str:
         if self.type is None:
-            return f"{self.name()}"
+            return self.NAME
         else:
             return f"{self.type}"
 
 
-@dataclass
+@dataclass(slots=True)
 class UnknownKind(MetaSymbolKind):
     """
     Represents an unknown symbol kind.
     """
 
-    def name(self) -> SymbolKindName:
-        return "Unknown"
+    NAME: ClassVar[SymbolKindName] = "Unknown"
 
 
-@dataclass
+@dataclass(slots=True)
 class ValueKind(SymbolKind):
     """
     Represents a value in the IR
@@ -531,16 +611,21 @@ class ValueKind(SymbolKind):
 
     type: Optional[Type] = None
 
-    def name(self) -> SymbolKindName:
-        return "Value"
+    NAME: ClassVar[SymbolKindName] = "Value"
 
     def dump(self, lines: List[str]) -> None:
         if self.type is not None:
             lines.append(f"   type: {self.type}")
 
 
-@dataclass
-class Symbol:
+# names of the kinds of MetaSymbolKind, to filter symbols by name instead of isinstance, which
+# goes through ABCMeta.__instancecheck__
+META_KIND_NAMES: FrozenSet[SymbolKindName] = frozenset(
+    kind.NAME for kind in MetaSymbolKind.__subclasses__()
+)
+
+
+class Symbol(msgspec.Struct, weakref=True):
     """Class for symbol information.
 
     Attributes:
@@ -619,8 +704,13 @@ class Symbol:
             id = self.name + signature
         else:
             id = self.name
-        lines.append(
-            f"{self.kind()}: {id}\n   language: {self.language}\n   range: {self.range}\n   substring: {self.substring}"
+        lines.extend(
+            (
+                f"{self.kind()}: {id}",
+                f"   language: {self.language}",
+                f"   range: {self.range}",
+                f"   substring: {self.substring}",
+            )
         )
         if self.scope != "":
             lines.append(f"   scope: {self.scope}")
@@ -630,35 +720,65 @@ class Symbol:
             lines.append(f"   exported: {self.exported}")
         if self.body_sub is not None:
             lines.append(f"   body_sub: {self.body_sub}")
-        if self.body != []:
+        if self.body:
             lines.append(f"   body: {self.body}")
         if self.parent:
             lines.append(f"   parent: {self.parent.get_qualified_id()}")
         self.symbol_kind.dump(lines)
 
     def kind(self) -> str:
-        return self.symbol_kind.name()
+        return self.symbol_kind.NAME
+
+
+_INDENTS = [" " * i for i in range(128)]
+
+
+def _indentation(indent: int) -> str:
+    """Returns a string of `indent` spaces, shared between calls for the usual depths."""
+    return _INDENTS[indent] if indent < len(_INDENTS) else " " * indent
+
+
+_file_symbol_cache: "weakref.WeakValueDictionary[Tuple[int, Language, str], Symbol]" = (
+    weakref.WeakValueDictionary()
+)
 
 
 def create_file_symbol(code: Code, language: Language, path: str) -> Symbol:
+    """
+    Creates the symbol of a whole file.
+
+    The symbols are cached by the identity of the code bytes while a symbol created from them
+    is alive. The cache only hits when a File is built again on the same bytes object, such as
+    a Code kept from an earlier parse; code read again from disk is a new bytes object, and
+    hashing its content would cost as much as the newline scan it saves.
+    """
+    # The bytes are kept alive by the cached symbol, so their id is not reused while it is cached
+    key = (id(code.bytes), language, path)
+    cached = _file_symbol_cache.get(key)
+    if cached is not None and cached.code.bytes is code.bytes:
+        return msgspec.structs.replace(
+            cached, body=Block(), code=code, symbol_kind=FileKind(), embedding=None
+        )
+
     # For body_sub
     start_byte = 0
-    end_byte = len(code.bytes) - 1
+    end_byte = len(code.bytes)
     body_sub = (start_byte, end_byte)
 
-    # For range
+    # For range, from the positions of the newlines of the code
+    newlines = code.newlines()
+    trailing_newline = 1 if code.bytes.endswith(b"\n") else 0
     first_line = 0
-    last_line = code.bytes.count(b"\n")
-    if code.bytes.endswith(b"\n"):
-        last_line -= 1  # Adjust for the last line if it ends with a newline
-    last_newline_pos = code.bytes.rfind(b"\n", 0, end_byte - 1)
-    if last_newline_pos == -1:  # If there's no newline, the entire content is a single line
-        last_char_in_line = end_byte
-    else:
-        last_char_in_line = end_byte - last_newline_pos - 1
+    last_line = len(newlines) - trailing_newline  # not counting a line after the last newline
+    content_end = end_byte - trailing_newline
+    if len(newlines) > trailing_newline:
+        last_newline_pos = int(newlines[-1 - trailing_newline])
+    else:  # If there's no newline, the entire content is a single line
+        last_newline_pos = -1
+    last_char_in_line = content_end - last_newline_pos - 1
     range = ((first_line, 0), (last_line, last_char_in_line))
 
-    return Symbol(
+    symbol = Symbol(
         body=Block(),
         body_sub=body_sub,
         code=code,
@@ -672,9 +792,11 @@ def create_file_symbol(code: Code, language: Language, path: str) -> Symbol:
         substring=body_sub,
         symbol_kind=FileKind(),
     )
+    _file_symbol_cache[key] = symbol
+    return symbol
 
 
-@dataclass
+@dataclass(slots=True)
 class File:
     """
     Represents a file with associated metadata.
@@ -683,19 +805,45 @@ class File:
     - path: Path of the file relative to the root directory.
     - statements: Top-level statements in the file.
     - _imports: Imports present in the file.
+    - _imports_by_module: First import of each module, for search_module_import.
     - _symbol_table: Symbol table for all symbols in the file.
+    - _function_declarations: The functions of the symbol table, in the same order.
+    - _symbols_by_name: The symbols of the symbol table with each name, in the same order.
+    - _embeddings_version: Bumped when symbols are added or embeddings change.
+    - _embedding_matrix: The version, embedded symbols and matrix of the last embedding_matrix.
+      It is not pickled.
     """
 
     code: Code
     path: str
     symbol: Optional[Symbol] = None
     _imports: List[Import] = field(default_factory=list)
+    _imports_by_module: Dict[str, Import] = field(default_factory=dict, repr=False, compare=False)
     _symbol_table: Dict[QualifiedId, Symbol] = field(default_factory=dict)
+    _function_declarations: Dict[QualifiedId, Symbol] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+    _symbols_by_name: Dict[str, Dict[QualifiedId, Symbol]] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+    _embeddings_version: int = field(default=0, repr=False, compare=False)
+    _embedding_matrix: Optional[Tuple[int, List[Symbol], Vector]] = field(
+        default=None, repr=False, compare=False
+    )
 
     def __post_init__(self) -> None:
         self.symbol = create_file_symbol(code=self.code, language="python", path=self.path)
         self.add_symbol(self.symbol)
 
+    def __getstate__(self) -> Dict[str, Any]:
+        state = {f.name: getattr(self, f.name) for f in fields(self)}
+        state["_embedding_matrix"] = None  # built again from the embeddings when needed
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def lookup_symbol(self, qid: QualifiedId) -> Optional[Symbol]:
         return self._symbol_table.get(qid)
 
@@ -704,54 +852,134 @@ class File:
             name_filter = name
             return [symbol for symbol in self._symbol_table.values() if name_filter(symbol.name)]
         else:
-            return [symbol for symbol in self._symbol_table.values() if symbol.name == name]
+            return list(self._symbols_by_name.get(name, {}).values())
 
     def search_module_import(self, module_name: str) -> Optional[Import]:
-        for import_ in self._imports:
-            if import_.module_name == module_name:
-                return import_
-        return None
+        return self._imports_by_module.get(module_name)
 
     def add_symbol(self, symbol: Symbol) -> None:
         if symbol.parent:
             symbol.parent.body.append(symbol)
-        self._symbol_table[symbol.get_qualified_id()] = symbol
+        # few distinct values are repeated over many symbols: share them and compare by identity
+        symbol.language = sys.intern(symbol.language)  # type: ignore
+        symbol.scope = sys.intern(symbol.scope)
+        symbol.name = sys.intern(symbol.name)
+        qid = symbol.get_qualified_id()
+        previous = self._symbol_table.get(qid)
+        self._symbol_table[qid] = symbol
+        self._embeddings_version += 1
+        if symbol.symbol_kind.NAME == "Function":
+            if previous is None or previous.symbol_kind.NAME == "Function":
+                self._function_declarations[qid] = symbol
+            else:  # takes the position of the replaced symbol in the symbol table
+                self._function_declarations = {
+                    qid: symbol
+                    for qid, symbol in self._symbol_table.items()
+                    if symbol.symbol_kind.NAME == "Function"
+                }
+        elif previous is not None:
+            self._function_declarations.pop(qid, None)
+        if previous is None or previous.name == symbol.name:
+            self._symbols_by_name.setdefault(symbol.name, {})[qid] = symbol
+        else:  # same qualified id with another name: move it between the names
+            same_name = self._symbols_by_name[previous.name]
+            del same_name[qid]
+            if not same_name:
+                del self._symbols_by_name[previous.name]
+            self._symbols_by_name[symbol.name] = {
+                qid: s for qid, s in self._symbol_table.items() if s.name == symbol.name
+            }
 
     def add_import(self, import_: Import) -> None:
         self._imports.append(import_)
+        if import_.module_name is not None:
+            self._imports_by_module.setdefault(import_.module_name, import_)
 
     def get_function_declarations(self) -> List[Symbol]:
-        return [
-            symbol
-            for symbol in self._symbol_table.values()
-            if isinstance(symbol.symbol_kind, FunctionKind)
-        ]
+        return list(self._function_declarations.values())
+
+    def embeddings_changed(self) -> None:
+        """Call after assigning the embeddings of symbols, so that embedding_matrix is rebuilt."""
+        self._embeddings_version += 1
+
+    def embedding_matrix(self) -> Tuple[List[Symbol], Vector]:
+        """
+        Returns the symbols that have an embedding, and their row-normalized embeddings stacked
+        in a float32 matrix. The matrix is rebuilt after add_symbol or embeddings_changed.
+        """
+        cached = self._embedding_matrix
+        if cached is not None and cached[0] == self._embeddings_version:
+            return cached[1], cached[2]
+        symbols: List[Symbol] = []
+        embeddings: List[Vector] = []
+        for symbol in self._symbol_table.values():
+            if symbol.embedding is not None:
+                symbols.append(symbol)
+                embeddings.append(symbol.embedding)
+        if embeddings:
+            matrix = np.array(embeddings, dtype=np.float32)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms != 0)
+        self._embedding_matrix = (self._embeddings_version, symbols, matrix)
+        return symbols, matrix
+
+    def batched_cosine(self, query: Vector) -> Vector:
+        """
+        Returns the cosine similarity of the query with the embedding of each symbol returned by
+        embedding_matrix, with a single matrix-vector product.
+        """
+        _symbols, matrix = self.embedding_matrix()
+        if len(matrix) == 0:
+            return np.zeros(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm != 0:
+            query = query / norm
+        return matrix @ query
+
+    def fused_walk(self, *visitors: Callable[[Symbol], None]) -> None:
+        """
+        Walks the symbol table once, calling each visitor on each symbol in turn, so that several
+        analyses of the file share one pass over the symbols.
+        """
+        for symbol in self._symbol_table.values():
+            for visitor in visitors:
+                visitor(symbol)
 
     def dump_symbol_table(self, lines: List[str]) -> None:
-        for _, symbol in self._symbol_table.items():
-            if not isinstance(symbol.symbol_kind, UnknownKind):
+        self.fused_walk(self.symbol_table_dumper(lines))
+
+    @staticmethod
+    def symbol_table_dumper(lines: List[str]) -> Callable[[Symbol], None]:
+        """Returns the visitor of dump_symbol_table, to combine it with others in fused_walk."""
+
+        def dump(symbol: Symbol) -> None:
+            if symbol.symbol_kind.NAME != "Unknown":
                 symbol.dump(lines)
 
+        return dump
+
     def dump_map(self, indent: int, lines: List[str]) -> None:
-        def dump_symbol(symbol: Symbol, indent: int) -> None:
-            if isinstance(symbol.symbol_kind, UnknownKind):
+        assert self.symbol and isinstance(self.symbol.symbol_kind, FileKind)
+        # pre-order walk with an explicit stack, children pushed in reverse to pop them in order
+        stack: List[Tuple[Symbol, int]] = [(s, indent) for s in reversed(self.symbol.body)]
+        while stack:
+            symbol, symbol_indent = stack.pop()
+            if symbol.symbol_kind.NAME == "Unknown":
                 pass
-            elif not isinstance(symbol.symbol_kind, MetaSymbolKind):
+            elif symbol.symbol_kind.NAME not in META_KIND_NAMES:
+                prefix = _indentation(symbol_indent)
                 decl_without_body = symbol.get_substring_without_body().decode().strip()
                 # indent the declaration
-                decl_without_body = decl_without_body.replace("\n", "\n" + " " * indent)
-                lines.append(f"{' ' * indent}{decl_without_body}")
+                lines.append(prefix + decl_without_body.replace("\n", "\n" + prefix))
             else:
-                lines.append(f"{' ' * indent}{symbol.name} = `{symbol.symbol_kind}`")
-            for s in symbol.body:
-                dump_symbol(s, indent + 2)
-
-        assert self.symbol and isinstance(self.symbol.symbol_kind, FileKind)
-        for symbol in self.symbol.body:
-            dump_symbol(symbol, indent)
+                lines.append(f"{_indentation(symbol_indent)}{symbol.name} = `{symbol.symbol_kind}`")
+            stack.extend((s, symbol_indent + 2) for s in reversed(symbol.body))
 
 
-@dataclass
+@dataclass(slots=True)
 class Reference:
     """
     A reference to a file, and optionally a symbol inside that file.
@@ -783,25 +1011,25 @@ class Reference:
         return Reference(file_path=file_path, qualified_id=qualified_id)
 
 
-@dataclass
+@dataclass(slots=True)
 class ResolvedReference:
     file: File
     symbol: Optional[Symbol] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Project:
     root_path: str
     _files: List[File] = field(default_factory=list)
+    # first file of each full path
+    _file_by_path: Dict[str, File] = field(default_factory=dict, repr=False, compare=False)
 
     def add_file(self, file: File):
         self._files.append(file)
+        self._file_by_path.setdefault(os.path.join(self.root_path, file.path), file)
 
     def lookup_file(self, path: str) -> Optional[File]:
-        for file in self._files:
-            if os.path.join(self.root_path, file.path) == path:
-                return file
-        return None
+        return self._file_by_path.get(path)
 
     def lookup_reference(self, reference: Reference) -> Optional[ResolvedReference]:
         file = self.lookup_file(reference.file_path)
@@ -818,40 +1046,33 @@ class Project:
     def dump_map(self, indent: int = 0) -> str:
         lines: List[str] = []
         for file in self.get_files():
-            lines.append(f"{' ' * indent}File: {file.path}")
+            lines.append(f"{_indentation(indent)}File: {file.path}")
             file.dump_map(indent + 2, lines)
         return "\n".join(lines)
 
 
+_LANGUAGE_OF_EXTENSION: Dict[str, Language] = {
+    ".c": "c",
+    ".cpp": "cpp",
+    ".cc": "cpp",
+    ".cxx": "cpp",
+    ".c++": "cpp",
+    ".cs": "c_sharp",
+    ".js": "javascript",
+    ".java": "java",
+    ".ml": "ocaml",
+    ".py": "python",
+    ".ts": "typescript",
+    ".tsx": "tsx",
+    ".rb": "ruby",
+}
+# languages whose parsers are only available when the custom parsers are active
+_CUSTOM_LANGUAGE_OF_EXTENSION: Dict[str, Language] = {".lean": "lean", ".res": "rescript"}
+
+
 def language_from_file_extension(file_path: str) -> Optional[Language]:
-    if file_path.endswith(".c"):
-        return "c"
-    elif (
-        file_path.endswith(".cpp")
-        or file_path.endswith(".cc")
-        or file_path.endswith(".cxx")
-        or file_path.endswith(".c++")
-    ):
-        return "cpp"
-    elif file_path.endswith(".cs"):
-        return "c_sharp"
-    elif file_path.endswith(".js"):
-        return "javascript"
-    elif file_path.endswith(".java"):
-        return "java"
-    elif file_path.endswith(".lean") and custom_parsers.active:
-        return "lean"
-    elif file_path.endswith(".ml"):
-        return "ocaml"
-    elif file_path.endswith(".py"):
-        return "python"
-    elif file_path.endswith(".res") and custom_parsers.active:
-        return "rescript"
-    elif file_path.endswith(".ts"):
-        return "typescript"
-    elif file_path.endswith(".tsx"):
-        return "tsx"
-    elif file_path.endswith(".rb"):
-        return "ruby"
-    else:
-        return None
+    extension = file_path[file_path.rfind(".") :]
+    language = _LANGUAGE_OF_EXTENSION.get(extension)
+    if language is None and custom_parsers.active:
+        language = _CUSTOM_LANGUAGE_OF_EXTENSION.get(extension)
+    return language
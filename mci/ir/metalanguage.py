@@ -20,6 +20,7 @@ class MetaLanguage:
     globals: Dict[str, Any] = field(default_factory=dict)
     code: str = ""
     _all_symbols: List[IR.Symbol] = field(default_factory=list)
+    _file_paths: Dict[int, str] = field(default_factory=dict)  # id(x) -> path of its file
 
     SymbolicType = Union[
         IR.FunctionKind,
@@ -30,17 +31,16 @@ class MetaLanguage:
         IR.TypeDefinitionKind,
     ]
 
-    @classmethod
     def set_file_path(
-        cls,
+        self,
         x: SymbolicType,
         path: str,
     ) -> None:
-        x._file_path = path  # type: ignore
+        # IR objects have slots, so the path is kept on the side
+        self._file_paths[id(x)] = path
 
-    @classmethod
-    def get_file_path(cls, x: SymbolicType) -> str:
-        return x._file_path  # type: ignore
+    def get_file_path(self, x: SymbolicType) -> str:
+        return self._file_paths[id(x)]
 
     def process_meta_variable(self, mv: str) -> None:
         if mv == "Class":
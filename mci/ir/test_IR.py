@@ -0,0 +1,183 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from . import IR
+
+
+def test_create_file_symbol_cache():
+    code = IR.Code(b"def f():\n    pass\n")
+    file = IR.File(code=code, path="f.py")
+    assert file.symbol is not None
+    file.symbol.embedding = np.ones(4, dtype=np.float32)
+
+    # a file built again on the same bytes gets a fresh copy of the cached symbol
+    assert IR._file_symbol_cache[(id(code.bytes), "python", "f.py")] is file.symbol
+    again = IR.File(code=IR.Code(code.bytes), path="f.py")
+    symbol = again.symbol
+    assert symbol is not None and symbol is not file.symbol
+    assert symbol.range == file.symbol.range and symbol.substring == file.symbol.substring
+    assert symbol.body is not file.symbol.body and symbol.body == []
+    assert symbol.symbol_kind is not file.symbol.symbol_kind
+    assert symbol.embedding is None
+    assert symbol.code is again.code
+
+    # other bytes with the same content are not looked up by content
+    other = IR.File(code=IR.Code(bytes(bytearray(code.bytes))), path="f.py")
+    assert other.symbol is not None and other.symbol.range == file.symbol.range
+
+
+def make_symbol(file: IR.File, scope: str, name: str, kind: IR.SymbolKind) -> IR.Symbol:
+    return IR.Symbol(
+        body=IR.Block(),
+        body_sub=None,
+        code=file.code,
+        docstring_sub=None,
+        exported=False,
+        language="python",
+        name=name,
+        range=((0, 0), (0, 0)),
+        parent=None,
+        scope=scope,
+        substring=(0, 0),
+        symbol_kind=kind,
+    )
+
+
+def function_kind() -> IR.FunctionKind:
+    return IR.FunctionKind(has_return=False, parameters=[])
+
+
+def test_function_declarations_replaced():
+    file = IR.File(code=IR.Code(b""), path="f.py")
+    for scope, name, kind in [
+        ("", "a", IR.ValueKind()),
+        ("", "b", function_kind()),
+        ("", "c", function_kind()),
+        ("", "a", function_kind()),  # a value replaced by a function keeps its position
+        ("", "b", IR.ValueKind()),  # a function replaced by a value
+        ("", "c", function_kind()),  # a function replaced by a function
+        ("", "d", function_kind()),
+    ]:
+        file.add_symbol(make_symbol(file, scope, name, kind))
+        expected = [
+            id(symbol)
+            for symbol in file._symbol_table.values()
+            if isinstance(symbol.symbol_kind, IR.FunctionKind)
+        ]
+        assert [id(symbol) for symbol in file.get_function_declarations()] == expected
+    assert [s.name for s in file.get_function_declarations()] == ["a", "c", "d"]
+
+
+def test_search_symbol_replaced():
+    file = IR.File(code=IR.Code(b""), path="f.py")
+    for scope, name in [
+        ("", "c"),
+        ("A.", "b.c"),
+        ("", "b.c"),
+        ("A.b.", "c"),  # replaces A.b.c, moving it from the name b.c to c
+        ("X.", "c"),
+        ("", "c"),  # replaces c with the same name
+    ]:
+        file.add_symbol(make_symbol(file, scope, name, IR.ValueKind()))
+        for query in ["c", "b.c", "f.py", "missing"]:
+            expected = [id(s) for s in file._symbol_table.values() if s.name == query]
+            assert [id(s) for s in file.search_symbol(query)] == expected
+    assert [s.get_qualified_id() for s in file.search_symbol("c")] == ["c", "A.b.c", "X.c"]
+    assert [s.get_qualified_id() for s in file.search_symbol("b.c")] == ["b.c"]
+
+
+def test_embedding_matrix():
+    file = IR.File(code=IR.Code(b""), path="f.py")
+    assert file.batched_cosine(np.ones(2, dtype=np.float32)).shape == (0,)
+    a = make_symbol(file, "", "a", IR.ValueKind())
+    b = make_symbol(file, "", "b", IR.ValueKind())
+    file.add_symbol(a)
+    file.add_symbol(b)
+    a.embedding = np.array([3, 4], dtype=np.float32)
+    b.embedding = np.array([1, 0], dtype=np.float32)
+    file.embeddings_changed()
+    query = np.array([0, 2], dtype=np.float32)
+    assert file.batched_cosine(query) == pytest.approx([0.8, 0.0])
+    symbols, matrix = file.embedding_matrix()
+    assert symbols == [a, b]
+    assert file.embedding_matrix()[1] is matrix  # cached
+
+    # rebuilt after the embeddings change or a symbol is added
+    b.embedding = np.array([0, 1], dtype=np.float32)
+    file.embeddings_changed()
+    assert file.batched_cosine(query) == pytest.approx([0.8, 1.0])
+    c = make_symbol(file, "", "c", IR.ValueKind())
+    c.embedding = np.array([-1, 0], dtype=np.float32)
+    file.add_symbol(c)
+    symbols, matrix = file.embedding_matrix()
+    assert symbols == [a, b, c] and matrix.shape == (3, 2)
+
+    # the matrix is not pickled
+    unpickled = pickle.loads(pickle.dumps(file))
+    assert unpickled._embedding_matrix is None
+    assert unpickled.batched_cosine(query) == pytest.approx([0.8, 1.0, 0.0])
+
+
+def test_code_positions():
+    for text in [b"", b"a", b"ab\n", b"ab\ncd", b"\n\nab\n\ncd\n", "é\nx".encode()]:
+        code = IR.Code(text)
+        assert code.newlines().tolist() == [n for n, c in enumerate(text) if c == ord("\n")]
+        line, column = 0, 0
+        for offset in range(len(text) + 1):  # including the newline bytes and the end
+            assert code.pos_of_offset(offset) == (line, column)
+            assert code.offset_of_pos((line, column)) == offset
+            if offset < len(text) and text[offset] == ord("\n"):
+                line, column = line + 1, 0
+                assert code.line_start(line) == offset + 1
+            else:
+                column += 1
+    assert IR.Code(b"").line_start(0) == 0
+    assert IR.Code(b"ab\ncd").pos_of_offset(2) == (0, 2)  # on the newline itself
+
+    # the newlines are not pickled, and are found again after unpickling
+    code = IR.Code(b"a\nb\n")
+    code.newlines()
+    unpickled = pickle.loads(pickle.dumps(code))
+    assert unpickled.bytes == code.bytes and unpickled._newlines is None
+    assert unpickled.pos_of_offset(2) == (1, 0)
+
+
+def test_apply_edits_overlapping():
+    code = IR.Code(b"0123456789")
+    edits = [
+        IR.CodeEdit(substring=(5, 7), new_bytes=b"ZZZ"),
+        IR.CodeEdit(substring=(0, 1), new_bytes=b""),
+        IR.CodeEdit(substring=(2, 2), new_bytes=b"X"),
+    ]
+    assert str(code.apply_edits(edits)) == "1X234ZZZ789"
+    overlapping = [
+        IR.CodeEdit(substring=(0, 5), new_bytes=b"a"),
+        IR.CodeEdit(substring=(3, 6), new_bytes=b"b"),
+    ]
+    with pytest.raises(ValueError):
+        code.apply_edits(overlapping)
+
+
+def test_apply_edits_sorted():
+    code = IR.Code(b"0123456789")
+    ascending = [
+        IR.CodeEdit(substring=(0, 1), new_bytes=b""),
+        IR.CodeEdit(substring=(2, 2), new_bytes=b"X"),
+        IR.CodeEdit(substring=(2, 4), new_bytes=b"R"),  # the insertion at 2 goes before it
+        IR.CodeEdit(substring=(5, 7), new_bytes=b"ZZZ"),
+    ]
+    expected = code
+    for edit in reversed(ascending):  # one by one from the end
+        expected = expected.apply_edit(edit)
+    assert str(expected) == "1XR4ZZZ789"
+    assert str(code.apply_edits(list(ascending), assume_sorted="asc")) == str(expected)
+    descending = list(reversed(ascending))
+    assert str(code.apply_edits(list(descending), assume_sorted="desc")) == str(expected)
+    unsorted = [ascending[2], ascending[0], ascending[3], ascending[1]]
+    assert str(code.apply_edits(unsorted)) == str(expected)
+    with pytest.raises(ValueError):
+        code.apply_edits(descending, assume_sorted="asc")
+    with pytest.raises(ValueError):
+        code.apply_edits(ascending, assume_sorted="desc")